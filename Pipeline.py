@@ -1,36 +1,105 @@
-from core import Repository, Extractor, Processor, PySZZ, Splitter
-from utils import clone_repo
+from core import Repository, StageCache
+from utils import clone_repo, count_commits, load_json, save_json, set_serialization
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stderr, redirect_stdout
+from argparse import Namespace
+import traceback
+import time
+import csv
+import os
+
+STAGES = ["extract", "features", "label", "process", "split"]
 
 
 class BasicPipeline:
-    def __init__(self, cfg):
-        # init extractor
-        self.extractor = Extractor(
+    def __init__(self, cfg, stages: list = STAGES):
+        """
+        A pipeline running `stages`. Only the components of these stages are
+        created, and their modules imported, e.g. extracting does not need
+        PySZZ nor pandas.
+        """
+        set_serialization(cfg.save_compression, cfg.save_compression_level)
+        self.cfg = cfg
+        self.stages = stages
+        if {"extract", "features"} & set(stages):
+            self.extractor = self.init_extractor(cfg)
+        if {"label", "process", "split"} & set(stages):
+            self.labeler = self.init_labeler(cfg)
+        if {"process", "split"} & set(stages):
+            self.processor = self.init_processor(cfg)
+        if "split" in stages:
+            self.splitter = self.init_splitter(cfg)
+
+    def init_extractor(self, cfg):
+        from core import CommitStore, Extractor
+
+        return Extractor(
             start=cfg.extractor_start,
             end=cfg.extractor_end,
             num_commits_per_file=cfg.extractor_num_commits_per_file,
+            max_shard_bytes=cfg.extractor_max_shard_bytes,
             language=cfg.repo_language,
             save=cfg.extractor_save,
             force_reextract=cfg.extractor_force_reextract,
             check_uncommit=cfg.extractor_check_uncommit,
+            num_git_workers=cfg.extractor_num_git_workers,
+            checkpoint_interval=cfg.extractor_checkpoint_interval,
+            include=cfg.extractor_include,
+            exclude=cfg.extractor_exclude,
+            blame=not cfg.extractor_no_blame,
+            max_files=cfg.extractor_max_files,
+            max_changed_lines=cfg.extractor_max_changed_lines,
+            max_file_size=cfg.extractor_max_file_size,
+            oversized=cfg.extractor_oversized,
+            command_timeout=cfg.extractor_command_timeout,
+            feature_engine=cfg.extractor_feature_engine,
+            validate_features=cfg.extractor_validate_features,
+            dedup_patches=cfg.extractor_dedup_patches,
+            commit_store=(
+                CommitStore(cfg.extractor_commit_store)
+                if cfg.extractor_commit_store
+                else None
+            ),
+            overlap_features=cfg.pipeline_overlap,
+            queue_size=cfg.pipeline_queue_size,
         )
 
-        # init pyszz
-        self.pyszz = PySZZ(
-            pyszz_path=cfg.pyszz_path,
-            log_path=cfg.pyszz_log_path,
-            pyszz_conf=cfg.pyszz_conf,
-            keep_output=cfg.pyszz_keep_output,
+    def init_labeler(self, cfg):
+        from core import BSZZ, PySZZ
+
+        assert cfg.labeler in ["pyszz", "bszz"], "Invalid labeler: {}".format(
+            cfg.labeler
         )
+        if cfg.labeler == "pyszz":
+            return PySZZ(
+                pyszz_path=cfg.pyszz_path,
+                log_path=cfg.pyszz_log_path,
+                pyszz_conf=cfg.pyszz_conf,
+                keep_output=cfg.pyszz_keep_output,
+            )
+        assert (
+            not cfg.extractor_no_blame
+        ), "BSZZ needs the blame data, run without --extractor_no_blame"
+        return BSZZ(save=cfg.extractor_save)
 
-        # init processor
-        self.processor = Processor(
+    def init_processor(self, cfg):
+        from core import Processor
+
+        return Processor(
             save_path=cfg.dataset_save_path,
             save=cfg.processor_save,
+            line_cache_size=cfg.processor_line_cache_size,
         )
 
-        # init splitter
-        self.splitter = Splitter(save_path=cfg.dataset_save_path)
+    def init_splitter(self, cfg):
+        from core import Splitter
+
+        return Splitter(
+            save_path=cfg.dataset_save_path,
+            parts=cfg.splitter_parts,
+            val_train_ratio=cfg.splitter_val_ratio,
+            seed=cfg.splitter_seed,
+        )
 
     def set_repo(self, cfg):
         assert cfg.mode in ["local", "remote"], "Invalid mode: {}".format(cfg.mode)
@@ -38,6 +107,14 @@ class BasicPipeline:
             self.repo = self.local_repo(cfg)
         else:
             self.repo = self.remote_repo(cfg)
+        self.processed = False
+        # whether the processed data in memory is the saved dataset
+        self.dataset_saved = False
+        self.cache = (
+            None
+            if cfg.pipeline_no_cache
+            else StageCache(self.repo.paths["stage_cache"])
+        )
 
     def local_repo(self, cfg):
         repo = Repository(
@@ -55,6 +132,10 @@ class BasicPipeline:
             cfg.repo_owner,
             cfg.repo_name,
             cfg.repo_clone_url,
+            bare=cfg.repo_clone_bare,
+            blob_filter=cfg.repo_clone_filter,
+            object_cache=cfg.repo_object_cache,
+            refs=cfg.repo_clone_refs,
         )
         repo = Repository(
             cfg.repo_owner,
@@ -65,33 +146,345 @@ class BasicPipeline:
         )
         return repo
 
+    def extract(self):
+        """
+        Extract the new commits, without their features
+        """
+        self.extractor.set_repo(self.repo)
+        self.extractor.run(features=False)
+
+    def features(self):
+        self.extractor.set_repo(self.repo)
+        self.extractor.run_features()
+
+    def label(self):
+        fingerprint = self.get_label_fingerprint()
+        if self.is_cached("label", fingerprint):
+            return self.labeler.load_output(self.repo)
+        print("Running {}...".format(type(self.labeler).__name__))
+        szz_output = self.labeler.label(self.repo)
+        self.record_stage("label", fingerprint, self.get_label_outputs())
+        return szz_output
+
+    def process(self, szz_output=None):
+        """
+        Process the labeled data, by default the output of the last labeling
+        """
+        self.processor.set_repo(self.repo)
+        fingerprint = self.get_process_fingerprint()
+        if self.is_cached("process", fingerprint):
+            self.processor.load_dataset()
+            self.processed = True
+            self.dataset_saved = True
+            return
+        if szz_output is None:
+            szz_output = self.labeler.load_output(self.repo)
+        print("Processing information...")
+        self.processor.run(szz_output, self.cfg.extractor_end)
+        self.processed = True
+        self.dataset_saved = self.processor.save
+        outputs = self.processor.get_dataset_paths().values()
+        self.record_stage(
+            "process", fingerprint, outputs if self.dataset_saved else None
+        )
+
+    def split(self):
+        """
+        Split the processed data, processing it first, or loading the cached
+        dataset, when the pipeline did not process it
+        """
+        if not self.processed:
+            self.process()
+        fingerprint = self.get_split_fingerprint()
+        if self.is_cached("split", fingerprint):
+            return
+        print("Splitting data...")
+        self.splitter.set_processor(self.processor)
+        self.splitter.run()
+        self.record_stage("split", fingerprint, self.splitter.outputs)
+
+    def is_cached(self, stage, fingerprint):
+        if self.cache is None or not self.cache.is_fresh(stage, fingerprint):
+            return False
+        print("Inputs of {} unchanged, reusing its output".format(stage))
+        return True
+
+    def record_stage(self, stage, fingerprint, outputs):
+        """
+        Record a completed stage, or forget it when its output is not saved
+        """
+        if self.cache is None:
+            return
+        if outputs is None:
+            self.cache.invalidate(stage)
+        else:
+            self.cache.record(stage, fingerprint, outputs)
+
+    def get_commits_hashes(self):
+        config = self.repo.get_last_config()
+        num_files = config.get("num_files", 0)
+        if config.get("last_file_num_commits", 0):
+            num_files += 1
+        return [
+            self.cache.hash_file(self.repo.get_commits_path(num))
+            for num in range(num_files)
+        ]
+
+    def get_label_fingerprint(self):
+        if self.cache is None:
+            return None
+        inputs = {
+            "labeler": self.cfg.labeler,
+            "conf": self.labeler.conf,
+            "language": self.repo.get_language(),
+            "bug_fix": self.cache.hash_file(self.repo.get_bug_fix_path()),
+            "commits": self.get_commits_hashes(),
+        }
+        if self.cfg.labeler == "pyszz":
+            inputs["pyszz_path"] = self.labeler.path
+        return self.cache.get_fingerprint(inputs)
+
+    def get_label_outputs(self):
+        """
+        Get the output files of the last labeling, or None if it is not saved
+        """
+        if self.cfg.labeler == "bszz":
+            path = self.repo.get_szz_output_path(self.labeler.conf)
+            return [path] if self.labeler.save and os.path.exists(path) else None
+        try:
+            info = self.labeler.get_lastest_output_info(self.repo.owner, self.repo.name)
+        except FileNotFoundError:
+            return None
+        return [self.labeler.get_output_path(info["file"])]
+
+    def get_process_fingerprint(self):
+        """
+        Without an end date, the processing depends on the current time and
+        is never cached
+        """
+        if self.cache is None or self.cfg.extractor_end is None:
+            return None
+        label_outputs = self.get_label_outputs()
+        if label_outputs is None:
+            return None
+        inputs = {
+            "labels": [self.cache.hash_file(path) for path in label_outputs],
+            "features": self.cache.hash_file(self.repo.paths["features"]),
+            "commits": self.get_commits_hashes(),
+            "end": self.cfg.extractor_end,
+        }
+        return self.cache.get_fingerprint(inputs)
+
+    def get_split_fingerprint(self):
+        if self.cache is None or not self.dataset_saved:
+            return None
+        inputs = {
+            "dataset": [
+                self.cache.hash_file(path)
+                for path in self.processor.get_dataset_paths().values()
+            ],
+            "splitter": self.splitter.get_config(),
+        }
+        return self.cache.get_fingerprint(inputs)
+
     def run(self):
         print("Running repository: {}/{}".format(self.repo.owner, self.repo.name))
         # extract repo
         self.extractor.set_repo(self.repo)
+        label_worker = None
+        if self.cfg.pipeline_overlap and self.cfg.labeler == "bszz":
+            # B-SZZ labels each bug fix as soon as it is extracted
+            label_worker = self.extractor.add_commit_worker(
+                lambda commits: self.labeler.run(self.repo, commits)
+            )
         self.extractor.run()
-        # run pyszz
-        print("Running PySZZ...")
-        self.pyszz.run(
-            self.repo.get_bug_fix_path(),
-            self.repo.get_pyszz_conf_path(self.pyszz.conf),
-            self.repo.get_repo_path(),
-            self.repo.get_language(),
+        # label bug inducing commits
+        if label_worker is not None and label_worker.started:
+            szz_output = label_worker.result
+            print("BSZZ output: {}".format(len(szz_output)))
+            self.record_stage(
+                "label", self.get_label_fingerprint(), self.get_label_outputs()
+            )
+        else:
+            szz_output = self.label()
+        # process data
+        self.process(szz_output)
+        # split data
+        self.split()
+        print("Done")
+
+    def run_stage(self, stage):
+        """
+        Run one stage on the data saved by the previous ones
+        """
+        print(
+            "Running {} on repository: {}/{}".format(
+                stage, self.repo.owner, self.repo.name
+            )
         )
-        szz_output = self.pyszz.get_lastest_output(
-            self.repo.owner,
-            self.repo.name,
+        getattr(self, stage)()
+        print("Done")
+
+
+def run_repo_pipeline(cfg, log_file=None):
+    """
+    Run a `BasicPipeline` for one repository, recording its errors instead of
+    raising them; an interruption, e.g. Ctrl-C, still stops the batch.
+    Used as the unit of work of `BatchPipeline`'s process pool.
+    """
+    result = {
+        "owner": cfg.repo_owner,
+        "name": cfg.repo_name,
+        "status": "done",
+        "error": None,
+        "start": int(time.time()),
+    }
+    try:
+        if log_file:
+            with open(log_file, "w") as f, redirect_stdout(f), redirect_stderr(f):
+                crawler = BasicPipeline(cfg)
+                crawler.set_repo(cfg)
+                crawler.run()
+        else:
+            crawler = BasicPipeline(cfg)
+            crawler.set_repo(cfg)
+            crawler.run()
+    except Exception:
+        result["status"] = "failed"
+        result["error"] = traceback.format_exc()
+    result["end"] = int(time.time())
+    result["duration"] = result["end"] - result["start"]
+    return result
+
+
+class BatchPipeline:
+    def __init__(self, cfg, num_workers: int = None, summary_path: str = None):
+        """
+        Crawl many repositories listed in a manifest over a shared process pool.
+
+        The manifest is a CSV file with a header, or a JSON list of objects.
+        Each entry needs `repo_owner` and `repo_name` and may override any
+        other option of `main.py` (e.g. `repo_clone_url`, `repo_language`).
+        """
+        self.cfg = cfg
+        self.num_workers = num_workers or os.cpu_count()
+        self.summary_path = os.path.abspath(
+            summary_path or os.path.join(cfg.pyszz_log_path, "batch_summary.json")
         )
-        print("PySZZ output: {}".format(len(szz_output)))
+        self.log_path = os.path.join(os.path.abspath(cfg.pyszz_log_path), "batch")
+        self.configs = []
 
-        # process data
-        print("Processing information...")
-        self.processor.set_repo(self.repo)
-        self.processor.run(szz_output, self.extractor.end)
+    def load_manifest(self, manifest_path: str, parsers={}):
+        """
+        `parsers` maps the options given as strings in the manifest, such as
+        `repo_language`, to the function parsing them on the command line
+        """
+        if manifest_path.endswith(".json"):
+            entries = load_json(manifest_path)
+        else:
+            with open(manifest_path, "r", newline="") as f:
+                entries = list(csv.DictReader(f))
+        assert isinstance(entries, list), "Invalid manifest: {}".format(manifest_path)
 
-        # split data
-        print("Splitting data...")
-        self.splitter.set_processor(self.processor)
-        self.splitter.run()
+        self.configs = []
+        for entry in entries:
+            assert entry.get("repo_owner") is not None and entry.get(
+                "repo_name"
+            ), "Invalid manifest entry: {}".format(entry)
+            cfg = Namespace(**vars(self.cfg))
+            for key, val in entry.items():
+                if val is None or val == "":
+                    continue
+                if key in parsers and isinstance(val, str):
+                    val = parsers[key](val)
+                setattr(cfg, key, val)
+            self.configs.append(cfg)
+        return self.configs
 
-        print("Done")
+    def get_repo_path(self, cfg):
+        repo_path = cfg.repo_path if cfg.mode == "local" else cfg.repo_clone_path
+        return os.path.join(repo_path, cfg.repo_owner, cfg.repo_name)
+
+    def estimate_sizes(self):
+        """
+        Estimate each repository's size by its commit count.
+        Repositories that are not cloned yet are unknown and scheduled first.
+        """
+        sizes = []
+        for cfg in self.configs:
+            repo_path = self.get_repo_path(cfg)
+            size = count_commits(repo_path) if os.path.exists(repo_path) else None
+            sizes.append(size)
+        return sizes
+
+    def schedule(self):
+        """
+        Order repositories by decreasing estimated size, so that the largest
+        ones start first and small ones fill the remaining workers
+        """
+        sizes = self.estimate_sizes()
+        order = sorted(
+            range(len(self.configs)),
+            key=lambda i: float("inf") if sizes[i] is None else sizes[i],
+            reverse=True,
+        )
+        return [(self.configs[i], sizes[i]) for i in order]
+
+    def run(self):
+        if not os.path.exists(self.log_path):
+            os.makedirs(self.log_path)
+        scheduled = self.schedule()
+        print(
+            "Crawling {} repositories with {} workers".format(
+                len(scheduled), self.num_workers
+            )
+        )
+
+        summary = []
+        with ProcessPoolExecutor(max_workers=self.num_workers) as pool:
+            futures = {}
+            for cfg, size in scheduled:
+                log_file = os.path.join(
+                    self.log_path, "{}_{}.log".format(cfg.repo_owner, cfg.repo_name)
+                )
+                future = pool.submit(run_repo_pipeline, cfg, log_file)
+                futures[future] = (cfg, size, log_file)
+
+            try:
+                for future in as_completed(futures):
+                    cfg, size, log_file = futures[future]
+                    try:
+                        result = future.result()
+                    except Exception:
+                        # the worker process itself died (e.g. killed by OOM)
+                        result = {
+                            "owner": cfg.repo_owner,
+                            "name": cfg.repo_name,
+                            "status": "failed",
+                            "error": traceback.format_exc(),
+                        }
+                    result["num_commits"] = size
+                    result["log"] = log_file
+                    summary.append(result)
+                    print(
+                        "[{}/{}] {}/{}: {}".format(
+                            len(summary),
+                            len(scheduled),
+                            cfg.repo_owner,
+                            cfg.repo_name,
+                            result["status"],
+                        )
+                    )
+                    save_json(summary, self.summary_path)
+            except KeyboardInterrupt:
+                # do not wait for the queued repositories when leaving the pool
+                pool.shutdown(wait=False, cancel_futures=True)
+                raise
+
+        num_failed = len([res for res in summary if res["status"] != "done"])
+        print(
+            "Done: {} succeeded, {} failed. Summary: {}".format(
+                len(summary) - num_failed, num_failed, self.summary_path
+            )
+        )
+        return summary
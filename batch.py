@@ -0,0 +1,30 @@
+from argparse import ArgumentParser
+from Pipeline import BatchPipeline
+from main import add_common_params, create_default_save_folders
+from main import parse_globs, parse_languages
+
+
+def get_params():
+    parser = ArgumentParser()
+    parser.add_argument("--manifest", type=str, required=True)
+    parser.add_argument("--num_workers", type=int, default=None)
+    parser.add_argument("--summary_path", type=str, default=None)
+    add_common_params(parser)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    config = get_params()
+    create_default_save_folders()
+    crawler = BatchPipeline(config, config.num_workers, config.summary_path)
+    crawler.load_manifest(
+        config.manifest,
+        {
+            "repo_language": parse_languages,
+            "repo_clone_refs": parse_globs,
+            "extractor_include": parse_globs,
+            "extractor_exclude": parse_globs,
+            "splitter_parts": parse_globs,
+        },
+    )
+    crawler.run()
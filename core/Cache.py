@@ -0,0 +1,93 @@
+from utils import load_json, save_json
+import hashlib
+import json
+import os
+
+HASH_CHUNK_SIZE = 1 << 20
+
+
+class StageCache:
+    def __init__(self, path: str):
+        """
+        Record the fingerprint of each pipeline stage's inputs and config with
+        the hashes of its outputs, so that a stage whose fingerprint matches
+        and whose outputs are unchanged can be skipped.
+
+        File's structure:
+        {
+            "files": {path: {"size": size, "mtime_ns": mtime_ns, "sha1": sha1}},
+            "stages": {stage: {"fingerprint": fingerprint, "outputs": {path: sha1}}}
+        }
+        """
+        self.path = path
+        cache = load_json(path)
+        self.files = cache.get("files", {})
+        self.stages = cache.get("stages", {})
+
+    def save(self):
+        # forget the hashes of the files removed since they were hashed
+        self.files = {
+            path: memo for path, memo in self.files.items() if os.path.exists(path)
+        }
+        save_json({"files": self.files, "stages": self.stages}, self.path)
+
+    def hash_file(self, path):
+        """
+        Get the sha1 of a file, or None if it does not exist. The hash is
+        only computed again when the file's size or mtime changes.
+        """
+        if not os.path.exists(path):
+            return None
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        memo = self.files.get(path)
+        if (
+            memo
+            and memo["size"] == stat.st_size
+            and memo["mtime_ns"] == stat.st_mtime_ns
+        ):
+            return memo["sha1"]
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                sha1.update(chunk)
+        self.files[path] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha1": sha1.hexdigest(),
+        }
+        return self.files[path]["sha1"]
+
+    def get_fingerprint(self, inputs: dict):
+        return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    def is_fresh(self, stage, fingerprint):
+        """
+        Whether `stage` was recorded with `fingerprint` and its outputs are
+        unchanged since
+        """
+        entry = self.stages.get(stage)
+        if fingerprint is None or not entry or entry["fingerprint"] != fingerprint:
+            return False
+        return all(
+            self.hash_file(path) == sha1 for path, sha1 in entry["outputs"].items()
+        )
+
+    def record(self, stage, fingerprint, outputs: list):
+        """
+        Record a completed stage and the hashes of its output files
+        """
+        if fingerprint is None:
+            self.invalidate(stage)
+            return
+        self.stages[stage] = {
+            "fingerprint": fingerprint,
+            "outputs": {
+                os.path.abspath(path): self.hash_file(path) for path in outputs
+            },
+        }
+        self.save()
+
+    def invalidate(self, stage):
+        if self.stages.pop(stage, None) is not None:
+            self.save()
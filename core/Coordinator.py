@@ -0,0 +1,249 @@
+from .Extractor import Extractor
+from .Repository import Repository
+from utils import get_ref_tips, load_pkl, save_pkl
+from contextlib import closing
+import sqlite3
+import socket
+import shutil
+import json
+import time
+import os
+
+
+class CrawlCoordinator:
+    def __init__(
+        self,
+        extractor: Extractor,
+        path: str,
+        range_size: int = 500,
+        lease_time: float = 3600,
+    ):
+        """
+        Spread the extraction of one repository's commits over processes or
+        nodes sharing `path`. `plan` lists the commits to extract and queues
+        them in ranges of `range_size`, workers claim the ranges and extract
+        them, and `merge` stores the extracted commits as a single run would,
+        then computes the features. A range claimed more than `lease_time`
+        seconds ago and not completed is handed out again.
+
+        The queue is a SQLite database, without WAL, so that `path` may be on
+        any file system with working file locks.
+
+        Folder's structure:
+        --path
+        |   --queue.db // the planned commit ids and the ranges' status
+        |   --ranges
+        |   |   --range_{num}.pkl // the commits, or statuses, of a range
+        """
+        assert extractor.save, "Distributed extraction needs --extractor_save"
+        assert (
+            not extractor.dedup_patches
+        ), "Distributed extraction does not support --extractor_dedup_patches"
+        self.extractor = extractor
+        self.path = os.path.abspath(path)
+        self.range_size = range_size
+        self.lease_time = lease_time
+        if not os.path.exists(os.path.join(self.path, "ranges")):
+            os.makedirs(os.path.join(self.path, "ranges"))
+        with self.connect() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS ids ("
+                "num INTEGER PRIMARY KEY, commit_id TEXT NOT NULL)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS ranges ("
+                "num INTEGER PRIMARY KEY, start INTEGER, end INTEGER, "
+                "status TEXT, worker TEXT, claimed REAL)"
+            )
+
+    def connect(self):
+        """
+        A new connection for each operation, as the queue is shared by
+        processes. Transactions are explicit.
+        """
+        return closing(
+            sqlite3.connect(
+                os.path.join(self.path, "queue.db"), timeout=60, isolation_level=None
+            )
+        )
+
+    def set_repo(self, repo: Repository):
+        self.repo = repo
+        self.extractor.set_repo(repo)
+
+    def get_range_path(self, num):
+        return os.path.join(self.path, "ranges", "range_{}.pkl".format(num))
+
+    def plan(self):
+        """
+        List the commits to extract, as `Extractor.run` does, and queue them.
+        A previous plan and its extracted ranges are dropped. Get the number
+        of ranges.
+        """
+        tips = get_ref_tips(cwd=self.repo.get_path())
+        found_ids = self.extractor.extract_repo_commit_ids(tips)[::-1]
+        self.repo.load_ids()
+        known_ids = set(self.repo.ids)
+        extracting_ids = [id for id in self.repo.ids if self.repo.ids[id] == -1]
+        extracting_ids += [id for id in found_ids if id not in known_ids]
+        starts = range(0, len(extracting_ids), self.range_size)
+        ranges = [
+            (num, start, min(start + self.range_size, len(extracting_ids)))
+            for num, start in enumerate(starts)
+        ]
+        shutil.rmtree(os.path.join(self.path, "ranges"))
+        os.makedirs(os.path.join(self.path, "ranges"))
+        with self.connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            db.execute("DELETE FROM meta")
+            db.execute("DELETE FROM ids")
+            db.execute("DELETE FROM ranges")
+            db.executemany(
+                "INSERT INTO meta (key, value) VALUES (?, ?)",
+                [
+                    ("repo", json.dumps([self.repo.owner, self.repo.name])),
+                    ("tips", json.dumps(tips)),
+                    ("found_ids", json.dumps(found_ids)),
+                ],
+            )
+            db.executemany(
+                "INSERT INTO ids (num, commit_id) VALUES (?, ?)",
+                enumerate(extracting_ids),
+            )
+            db.executemany(
+                "INSERT INTO ranges (num, start, end, status) "
+                "VALUES (?, ?, ?, 'pending')",
+                ranges,
+            )
+            db.execute("COMMIT")
+        print(
+            "Planned {} commits in {} ranges".format(len(extracting_ids), len(ranges))
+        )
+        return len(ranges)
+
+    def get_meta(self, key):
+        with self.connect() as db:
+            row = db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        assert row is not None, "No plan in {}".format(self.path)
+        return json.loads(row[0])
+
+    def check_plan(self):
+        assert self.get_meta("repo") == [
+            self.repo.owner,
+            self.repo.name,
+        ], "The plan in {} is for {}".format(self.path, self.get_meta("repo"))
+
+    def claim(self, worker):
+        """
+        Claim the first range not claimed yet, or whose lease has expired.
+        Get (num, commit ids), or None when there is none left.
+        """
+        with self.connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute(
+                "SELECT num, start, end FROM ranges WHERE status = 'pending' "
+                "OR (status = 'running' AND claimed < ?) ORDER BY num LIMIT 1",
+                (time.time() - self.lease_time,),
+            ).fetchone()
+            if row is None:
+                db.execute("COMMIT")
+                return None
+            num, start, end = row
+            db.execute(
+                "UPDATE ranges SET status = 'running', worker = ?, claimed = ? "
+                "WHERE num = ?",
+                (worker, time.time(), num),
+            )
+            ids = [
+                commit_id
+                for (commit_id,) in db.execute(
+                    "SELECT commit_id FROM ids WHERE num >= ? AND num < ? ORDER BY num",
+                    (start, end),
+                )
+            ]
+            db.execute("COMMIT")
+        return num, ids
+
+    def complete(self, num):
+        with self.connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            db.execute("UPDATE ranges SET status = 'done' WHERE num = ?", (num,))
+            db.execute("COMMIT")
+
+    def get_progress(self):
+        """
+        Get the number of ranges by status
+        """
+        with self.connect() as db:
+            rows = db.execute("SELECT status, COUNT(*) FROM ranges GROUP BY status")
+            return dict(rows.fetchall())
+
+    def work(self, worker: str = None):
+        """
+        Extract ranges until none is left to claim. Get the number of ranges
+        extracted by this worker.
+        """
+        self.check_plan()
+        worker = worker or "{}:{}".format(socket.gethostname(), os.getpid())
+        num_ranges = 0
+        while True:
+            claimed = self.claim(worker)
+            if claimed is None:
+                break
+            num, ids = claimed
+            print("{}: extracting range {} ({} commits)".format(worker, num, len(ids)))
+            results = {}
+            for commit_id, commit in self.extractor.iter_commit_diffs(ids):
+                # a commit without diff is only stored by its status
+                if not isinstance(commit, int) and not commit["diff"]:
+                    commit = -2
+                results[commit_id] = commit
+            save_pkl(results, self.get_range_path(num))
+            self.complete(num)
+            num_ranges += 1
+        return num_ranges
+
+    def iter_range_results(self, commit_ids):
+        """
+        Yield each of `commit_ids` with its commit or status, from the
+        extracted ranges
+        """
+        with self.connect() as db:
+            nums = {
+                commit_id: num for num, commit_id in db.execute("SELECT * FROM ids")
+            }
+            ranges = db.execute("SELECT num, start, end FROM ranges").fetchall()
+        range_nums = {}
+        for num, start, end in ranges:
+            for i in range(start, end):
+                range_nums[i] = num
+        loaded = (None, {})
+        for commit_id in commit_ids:
+            assert commit_id in nums, "Commit {} is not planned".format(commit_id)
+            num = range_nums[nums[commit_id]]
+            if loaded[0] != num:
+                loaded = (num, load_pkl(self.get_range_path(num)))
+            yield commit_id, loaded[1][commit_id]
+
+    def merge(self):
+        """
+        Store the extracted ranges into the repository's shards and compute
+        the features, exactly as a single `Extractor.run` would
+        """
+        self.check_plan()
+        progress = self.get_progress()
+        num_pending = sum(
+            count for status, count in progress.items() if status != "done"
+        )
+        assert num_pending == 0, "Ranges not extracted yet: {}".format(progress)
+        tips = self.get_meta("tips")
+        self.extractor.date = int(time.time())
+        if self.extractor.is_up_to_date(tips):
+            print("No new commits since the last run")
+            return
+        self.extractor.run_commits(
+            self.get_meta("found_ids"), tips, fetch=self.iter_range_results
+        )
@@ -0,0 +1,204 @@
+from .Extractor import Extractor
+from .Repository import Repository
+from .State import FeatureState
+from utils import get_ref_tips
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from urllib.parse import parse_qs, urlparse
+import threading
+import json
+import time
+import os
+
+
+class ScoringDaemon:
+    def __init__(self, extractor: Extractor, repo: Repository):
+        """
+        Keep a repository's per-file and per-author state in memory to score
+        changes without replaying the history. Commits landing in the
+        repository are added to the state before each score.
+        """
+        self.extractor = extractor
+        self.repo = repo
+        self.lock = threading.Lock()
+        self.head = None
+        self.tips = None
+        self.known_ids = set()
+
+    def load(self):
+        """
+        Load the state saved by the last feature extraction, or replay the
+        extracted commits if there is none
+        """
+        self.extractor.set_repo(self.repo)
+        if self.extractor.ref_tips_range is not None:
+            # only add the commits of the extracted date range to its state
+            self.extractor.start, self.extractor.end = self.extractor.ref_tips_range
+        self.repo.load_ids()
+        self.repo.load_features()
+        if not self.repo.load_state():
+            print("No saved state, replaying extracted commits ...")
+            self.repo.state = FeatureState()
+            for num in range(self.extractor.get_num_commit_files()):
+                self.repo.load_commits(num)
+                for commit in self.repo.commits.values():
+                    self.extractor.extract_one_commit_features(commit)
+            self.repo.commits = {}
+        self.known_ids = {id for id, status in self.repo.ids.items() if status != -1}
+        self.refresh()
+
+    def refresh(self):
+        """
+        Add the commits that landed since the last refresh to the state. Only
+        the commits reachable from new ref tips are listed.
+        """
+        with self.lock:
+            tips = get_ref_tips(cwd=self.repo.get_path())
+            if tips == self.tips:
+                return 0
+            found_ids = self.extractor.extract_repo_commit_ids(tips)[::-1]
+            new_ids = [id for id in found_ids if id not in self.known_ids]
+            for commit_id in new_ids:
+                self.known_ids.add(commit_id)
+                try:
+                    commit = self.extractor.extract_one_commit_diff(
+                        commit_id, self.extractor.language
+                    )
+                except Exception:
+                    continue
+                if commit["diff"]:
+                    self.repo.features[commit_id] = (
+                        self.extractor.extract_one_commit_features(commit)
+                    )
+            self.extractor.ref_tips = tips
+            self.extractor.ref_tips_range = [self.extractor.start, self.extractor.end]
+            self.tips = tips
+            self.head = tips.get("HEAD")
+            return len(new_ids)
+
+    def score_commit(self, commit_id):
+        self.refresh()
+        with self.lock:
+            if commit_id in self.repo.features:
+                return self.repo.features[commit_id]
+            commit = self.extractor.extract_one_commit_diff(
+                commit_id, self.extractor.language
+            )
+            if not commit["diff"]:
+                return None
+            return self.extractor.extract_one_commit_features(commit, update=False)
+
+    def score_uncommit(self):
+        self.refresh()
+        with self.lock:
+            commit = self.extractor.extract_repo_uncommit()
+            if not commit or not commit["diff"]:
+                return None
+            return self.extractor.extract_one_commit_features(commit, update=False)
+
+    def score_patch(self, patch, author, message=""):
+        """
+        Score a patch applied on HEAD, with any context size. Raise
+        `ValueError` if it does not apply.
+        """
+        self.refresh()
+        with self.lock:
+            diff_log = self.extractor.expand_patch(patch, self.head)
+            commit = self.extractor.extract_patch(
+                diff_log, author, self.head, "patch", message
+            )
+            if not commit["diff"]:
+                return None
+            return self.extractor.extract_one_commit_features(commit, update=False)
+
+    def serve(self, host="127.0.0.1", port=8765, socket_path=None):
+        """
+        Serve the daemon over HTTP, on `host:port` or on a Unix socket:
+            GET  /health
+            GET  /score                 features of the working tree
+            GET  /score?commit=<id>     features of a commit
+            POST /score?author=<name>   features of the patch in the body
+            POST /refresh               add new commits to the state
+        """
+        handler = type("Handler", (ScoringRequestHandler,), {"daemon": self})
+        if socket_path:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            server = UnixHTTPServer(socket_path, handler)
+            print("Serving on {}".format(socket_path))
+        else:
+            server = ThreadingHTTPServer((host, port), handler)
+            print("Serving on http://{}:{}".format(host, port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if socket_path and os.path.exists(socket_path):
+                os.remove(socket_path)
+
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ("unix", 0)
+
+
+class ScoringRequestHandler(BaseHTTPRequestHandler):
+    daemon = None
+
+    def send_json(self, code, data):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_route(self, method):
+        url = urlparse(self.path)
+        query = {key: val[0] for key, val in parse_qs(url.query).items()}
+        start = time.time()
+        if method == "GET" and url.path == "/health":
+            data = {
+                "head": self.daemon.head,
+                "num_features": len(self.daemon.repo.features),
+            }
+        elif method == "GET" and url.path == "/score":
+            if "commit" in query:
+                data = {"feature": self.daemon.score_commit(query["commit"])}
+            else:
+                data = {"feature": self.daemon.score_uncommit()}
+        elif method == "POST" and url.path == "/score":
+            length = int(self.headers.get("Content-Length", 0))
+            patch = self.rfile.read(length).decode("utf8", errors="replace")
+            data = {
+                "feature": self.daemon.score_patch(
+                    patch, query.get("author", ""), query.get("message", "")
+                )
+            }
+        elif method == "POST" and url.path == "/refresh":
+            data = {"num_new_commits": self.daemon.refresh()}
+        else:
+            return self.send_json(404, {"error": "Not found: {}".format(url.path)})
+        data["time_ms"] = (time.time() - start) * 1000
+        self.send_json(200, data)
+
+    def do_GET(self):
+        try:
+            self.handle_route("GET")
+        except ValueError as e:
+            self.send_json(400, {"error": str(e)})
+        except Exception as e:
+            self.send_json(500, {"error": repr(e)})
+
+    def do_POST(self):
+        try:
+            self.handle_route("POST")
+        except ValueError as e:
+            self.send_json(400, {"error": str(e)})
+        except Exception as e:
+            self.send_json(500, {"error": repr(e)})
@@ -1,10 +1,22 @@
 from .Repository import Repository
+from .State import FeatureState
+from .Store import CommitStore
 from utils import *
 import time
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import pandas as pd
 import datetime
+import copy
+import itertools
+import subprocess
+import tempfile
+from array import array
+
+
+class OversizedCommitError(Exception):
+    pass
+
 
 class Extractor:
     def __init__(
@@ -12,20 +24,68 @@ class Extractor:
         start: str = None,
         end: str = None,
         num_commits_per_file: int = 5000,
+        max_shard_bytes: int = 0,
         language: list = [],
         save: bool = True,
         force_reextract: bool = False,
         check_uncommit:bool=False,
+        num_git_workers: int = 8,
+        checkpoint_interval: int = 60,
+        include: list = [],
+        exclude: list = [],
+        blame: bool = True,
+        max_files: int = 0,
+        max_changed_lines: int = 0,
+        max_file_size: int = 0,
+        oversized: str = "skip",
+        command_timeout: float = None,
+        feature_engine: str = "loop",
+        validate_features: bool = False,
+        dedup_patches: bool = False,
+        commit_store: CommitStore = None,
+        overlap_features: bool = False,
+        queue_size: int = 1000,
     ):
         self.start = start
         self.end = end
         self.num_commits_per_file = num_commits_per_file
+        self.max_shard_bytes = max_shard_bytes
         self.last_file_num_commits = 0
+        self.last_file_num_bytes = 0
         self.num_files = 0
+        self.unsaved_ids = []
         self.language = language
         self.save = save
         self.force_reextract = force_reextract
         self.check_uncommit = check_uncommit
+        self.num_git_workers = num_git_workers
+        self.checkpoint_interval = checkpoint_interval
+        self.include = include
+        self.exclude = exclude
+        self.blame = blame
+        self.blame_divergence = None
+        self.ref_tips = None
+        self.ref_tips_range = None
+        assert oversized in ["skip", "truncate"], "Invalid oversized: {}".format(
+            oversized
+        )
+        self.max_files = max_files
+        self.max_changed_lines = max_changed_lines
+        self.max_file_size = max_file_size
+        self.oversized = oversized
+        self.command_timeout = command_timeout
+        assert feature_engine in ["loop", "bulk"], "Invalid feature engine: {}".format(
+            feature_engine
+        )
+        self.feature_engine = feature_engine
+        self.validate_features = validate_features
+        self.dedup_patches = dedup_patches
+        self.commit_store = commit_store
+        self.canonical_shard = (None, {})
+        self.overlap_features = overlap_features
+        self.queue_size = queue_size
+        self.commit_workers = []
+        self.executor = None
 
     def set_repo(self, repo: Repository):
         self.repo = repo
@@ -34,40 +94,147 @@ class Extractor:
             self.reset_repo()
         else:
             print("Continue extracting repository ...")
+        self.ref_tips = None
+        self.ref_tips_range = None
         self.load_config(repo.get_last_config())
+        if self.commit_store is not None:
+            repo.set_commit_store(self.commit_store, self.get_store_options_key())
 
     def load_config(self, config):
         keys = [
             "num_commits_per_file",
+            "max_shard_bytes",
             "last_file_num_commits",
+            "last_file_num_bytes",
             "num_files",
             "language",
+            "include",
+            "exclude",
+            "blame",
+            "max_files",
+            "max_changed_lines",
+            "max_file_size",
+            "oversized",
+            "ref_tips",
+            "ref_tips_range",
+            "dedup_patches",
         ]
         if config:
             for key in keys:
                 if key in config:
                     setattr(self, key, config[key])
 
+    def get_store_options_key(self):
+        """
+        Key the options changing the content of an extracted commit
+        """
+        return CommitStore.get_options_key(
+            {
+                "language": sorted(self.language),
+                "include": self.include,
+                "exclude": self.exclude,
+                "blame": self.blame,
+                "max_files": self.max_files,
+                "max_changed_lines": self.max_changed_lines,
+                "max_file_size": self.max_file_size,
+                "oversized": self.oversized,
+                "dedup_patches": self.dedup_patches,
+            }
+        )
+
     def reset_repo(self):
+        if self.commit_store is not None:
+            self.commit_store.remove_repo(self.repo.get_store_repo_key())
         for path in self.repo.paths:
             if os.path.exists(self.repo.paths[path]):
                 os.remove(self.repo.paths[path])
+        self.repo.bug_fix_ids = None
+        self.repo.shards = None
+        num = 0
+        while os.path.exists(self.repo.get_commits_path(num)) or os.path.exists(
+            self.repo.get_journal_path(num)
+        ):
+            for path in [
+                self.repo.get_commits_path(num),
+                self.repo.get_journal_path(num),
+            ]:
+                if os.path.exists(path):
+                    os.remove(path)
+            num += 1
 
     def save_config(self):
         config = {
             "date": self.date,
             "num_commits_per_file": self.num_commits_per_file,
+            "max_shard_bytes": self.max_shard_bytes,
             "last_file_num_commits": self.last_file_num_commits,
+            "last_file_num_bytes": self.last_file_num_bytes,
             "num_files": self.num_files,
             "language": self.language,
+            "include": self.include,
+            "exclude": self.exclude,
+            "blame": self.blame,
+            "max_files": self.max_files,
+            "max_changed_lines": self.max_changed_lines,
+            "max_file_size": self.max_file_size,
+            "oversized": self.oversized,
+            "ref_tips": self.ref_tips,
+            "ref_tips_range": self.ref_tips_range,
+            "dedup_patches": self.dedup_patches,
         }
+        if self.commit_store is not None:
+            config["commit_store"] = self.commit_store.path
+        if self.blame_divergence:
+            config["blame_divergence"] = self.blame_divergence
         self.repo.save_config(config)
 
-    def run(self):
+    def extract(self, repo: Repository):
+        """
+        Extract `repo` on a copy of this extractor, so that the same instance
+        can extract several repositories concurrently
+        """
+        extractor = copy.copy(self)
+        extractor.last_file_num_commits = 0
+        extractor.num_files = 0
+        extractor.commit_workers = []
+        extractor.unsaved_ids = []
+        # each copy runs its commands on its own loop, closed once extracted
+        extractor.executor = None
+        try:
+            extractor.set_repo(repo)
+            extractor.run()
+        finally:
+            if extractor.executor is not None:
+                extractor.executor.close()
+        return extractor
+
+    def extract_repos(self, repos: list, num_workers: int = 4):
+        """
+        Extract several repositories concurrently with a thread pool
+        """
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            return list(pool.map(self.extract, repos))
+
+    def run(self, features: bool = True):
+        """
+        Extract the new commits and, unless `features=False`, the features of
+        all the commits. The ref tips are only recorded with the features.
+        """
         self.date = int(time.time())
-        cur_dir = os.getcwd()
-        os.chdir(self.repo.get_path())
-        found_ids = self.extract_repo_commit_ids()[::-1]
+        tips = get_ref_tips(cwd=self.repo.get_path())
+        if self.is_up_to_date(tips):
+            print("No new commits since the last run")
+            self.close_commit_workers()
+            return
+        found_ids = self.extract_repo_commit_ids(tips)[::-1]
+        self.run_commits(found_ids, tips, features)
+
+    def run_commits(self, found_ids, tips, features=True, fetch=None):
+        """
+        Extract the commits `found_ids`, oldest first, the features and record
+        the ref `tips` they were found from. `fetch` gets the commits already
+        extracted elsewhere, see `extract_repo_commit_diffs`.
+        """
         self.repo.load_ids()
         for id in found_ids:
             if id not in self.repo.ids:
@@ -75,22 +242,352 @@ class Extractor:
         self.date = int(time.time())
         if self.check_uncommit:
             self.repo.uncommit = {}
-        self.extract_repo_commit_diffs()
+        features_worker = None
+        # the bulk engine needs all the commits at once
+        if (
+            features
+            and self.overlap_features
+            and self.feature_engine == "loop"
+            and not self.validate_features
+        ):
+            features_worker = self.add_commit_worker(
+                self.extract_repo_commits_features_loop
+            )
+        self.extract_repo_commit_diffs(fetch)
+        if not features:
+            if self.save:
+                self.save_config()
+            return
+        if features_worker is None or not features_worker.started:
+            self.extract_repo_commits_features()
+        # the tips are only recorded once all their commits are extracted
+        self.ref_tips = tips
+        self.ref_tips_range = [self.start, self.end]
+        if self.save:
+            self.save_config()
+
+    def run_features(self):
+        """
+        Compute the features of the commits extracted by previous runs
+        """
+        self.date = int(time.time())
         self.extract_repo_commits_features()
         if self.save:
             self.save_config()
-        os.chdir(cur_dir)
 
-    def extract_repo_commit_ids(self):
+    def is_up_to_date(self, tips):
+        """
+        Whether the last completed run already extracted the same tips, with
+        the same date range, and saved their features
+        """
+        return (
+            self.save
+            and not self.check_uncommit
+            and self.ref_tips == tips
+            and self.ref_tips_range == [self.start, self.end]
+            and os.path.exists(self.repo.paths["features"])
+        )
+
+    def extract_repo_commit_ids(self, tips=None):
+        """
+        Extract the repository's commit ids. When the tips of the last run are
+        known, only the commits reachable from the new tips are listed.
+        """
+        repo_path = self.repo.get_path()
+        if (
+            tips is not None
+            and self.ref_tips is not None
+            and self.ref_tips_range == [self.start, self.end]
+        ):
+            ids = get_new_commit_hashes(
+                tips, self.ref_tips, self.start, self.end, cwd=repo_path
+            )
+            if ids is not None:
+                return ids
+        return get_commit_hashes(self.start, self.end, cwd=repo_path)
+
+    def add_commit_worker(self, consume):
+        """
+        Run `consume` in a thread on the stream of the extracted commits, in
+        replay order, while the next run extracts them. Get the worker, whose
+        `result` is set by the end of the extraction. The worker is not
+        started when there is nothing to extract.
+        """
+        worker = QueueWorker(
+            lambda items: consume(self.iter_published_commits(items)),
+            self.queue_size,
+        )
+        self.commit_workers.append(worker)
+        return worker
+
+    def start_commit_workers(self):
+        """
+        Start the commit workers and publish the commits extracted so far:
+        the saved shards, by number, then the current shard
+        """
+        for worker in self.commit_workers:
+            worker.start()
+            for num in range(self.num_files):
+                worker.put(num)
+            for commit in list(self.repo.commits.values()):
+                worker.put(commit)
+
+    def publish_commit(self, commit):
+        for worker in self.commit_workers:
+            if worker.started:
+                worker.put(commit)
+
+    def close_commit_workers(self):
+        workers, self.commit_workers = self.commit_workers, []
+        for worker in workers:
+            if worker.started:
+                worker.close()
+
+    def iter_published_commits(self, items):
+        for item in items:
+            if isinstance(item, int):
+                yield from self.repo.read_commits(item).values()
+            else:
+                yield item
+
+    def get_executor(self):
+        if self.executor is None:
+            self.executor = AsyncExecutor(self.num_git_workers, self.command_timeout)
+        return self.executor
+
+    def prefetch_one_commit(self, commit_id: str, languages=None, diff=True):
+        """
+        Start the `git show` commands of a commit without waiting for them.
+        Files filtered out by language or path are not even diffed by git.
+        The diff of a duplicated patch is not needed: `diff=False`.
+        """
+        if languages is None:
+            languages = self.language
+        pathspecs = get_pathspecs(languages, self.include, self.exclude)
+        prefetched = {
+            "pathspecs": pathspecs,
+            "show": self.get_executor().submit(
+                [
+                    "git",
+                    "show",
+                    commit_id,
+                    "--name-only",
+                    "--pretty=format:%H%n%P%n%an%n%ct%n%s%n%B%n[ALL CHANGE FILES]",
+                ],
+                cwd=self.repo.get_path(),
+            ),
+        }
+        if diff:
+            self.prefetch_diff(commit_id, prefetched)
+        return prefetched
+
+    def prefetch_diff(self, commit_id: str, prefetched: dict):
+        pathspecs = prefetched["pathspecs"]
+        if self.has_limits():
+            # the diff waits for the commit to be checked against the limits
+            prefetched["numstat"] = self.get_executor().submit(
+                ["git", "show", commit_id, "--numstat", "-z", "--format=", "--"]
+                + pathspecs,
+                cwd=self.repo.get_path(),
+            )
+        else:
+            prefetched["diff"] = self.submit_diff(commit_id, pathspecs)
+
+    def submit_diff(self, commit_id: str, pathspecs: list):
+        return self.get_executor().submit(
+            ["git", "show", commit_id, "--pretty=format:", "--unified=999999999"]
+            + ["--"]
+            + pathspecs,
+            cwd=self.repo.get_path(),
+        )
+
+    def has_limits(self):
+        return bool(self.max_files or self.max_changed_lines or self.max_file_size)
+
+    def parse_numstat(self, numstat_log):
+        """
+        Parse `git show --numstat -z` into a list of (path, changed lines),
+        changed lines being None for binary files
+        """
+        tokens = "\n".join(numstat_log).split("\0")
+        numstat = []
+        i = 0
+        while i < len(tokens):
+            parts = tokens[i].strip("\n").split("\t")
+            i += 1
+            if len(parts) != 3:
+                continue
+            added, deleted, path = parts
+            if not path:
+                # renamed file: the old and new paths follow
+                path = tokens[i + 1] if i + 1 < len(tokens) else ""
+                i += 2
+            changed = None if added == "-" else int(added) + int(deleted)
+            numstat.append((path, changed))
+        return numstat
+
+    def get_file_sizes(self, revs: list, paths: list):
+        """
+        Get the largest blob size of each path among `revs`
+        """
+        pathspecs = [":(literal){}".format(path) for path in paths]
+        if len(pathspecs) > 1000:
+            pathspecs = []
+        commands = [
+            ["git", "ls-tree", "-r", "-l", "-z", rev, "--"] + pathspecs
+            for rev in revs
+            if rev
+        ]
+        sizes = {}
+        for output in self.get_executor().run_all(commands, cwd=self.repo.get_path()):
+            for entry in "\n".join(output).split("\0"):
+                # <mode> <type> <object> <size>\t<path>
+                if "\t" not in entry:
+                    continue
+                meta, path = entry.split("\t", 1)
+                size = meta.split()[-1]
+                if size.isdigit():
+                    sizes[path] = max(sizes.get(path, 0), int(size))
+        return sizes
+
+    def check_limits(self, commit_id, parent_id, numstat_log, pathspecs):
         """
-        Extract the repository's commit ids
+        Check a commit against the size limits before diffing it.
+        Output:
+            pathspecs: the pathspecs to diff, None if the commit is skipped
+            truncated: whether some files of the commit are left out
         """
-        return get_commit_hashes(self.start, self.end)
+        numstat = self.parse_numstat(numstat_log)
+        too_large = set()
+        if self.max_file_size:
+            sizes = self.get_file_sizes(
+                [commit_id, parent_id], [path for path, _ in numstat]
+            )
+            too_large = set(
+                path for path, _ in numstat if sizes.get(path, 0) > self.max_file_size
+            )
+        if self.max_changed_lines:
+            too_large.update(
+                path
+                for path, changed in numstat
+                if changed and changed > self.max_changed_lines
+            )
+        kept = [(path, changed) for path, changed in numstat if path not in too_large]
+        changed_lines = sum(changed for _, changed in kept if changed)
+        oversized = (self.max_files and len(kept) > self.max_files) or (
+            self.max_changed_lines and changed_lines > self.max_changed_lines
+        )
+        if not oversized and not too_large:
+            return pathspecs, False
+        # a commit whose files are all above the limits is skipped in any mode
+        if not kept or (self.oversized == "skip" and oversized):
+            return None, False
+        if not oversized:
+            pathspecs = pathspecs + [
+                ":(exclude,literal){}".format(path) for path in too_large
+            ]
+            return pathspecs, True
 
-    def extract_one_commit_diff(self, commit_id: str, languages=[]):
+        # truncate: keep files in order while they fit in the limits
+        truncated_files = []
+        changed_lines = 0
+        for path, changed in kept:
+            if self.max_files and len(truncated_files) >= self.max_files:
+                break
+            if (
+                self.max_changed_lines
+                and changed_lines + (changed or 0) > self.max_changed_lines
+            ):
+                continue
+            truncated_files.append(path)
+            changed_lines += changed or 0
+        if not truncated_files:
+            return None, False
+        return [":(literal){}".format(path) for path in truncated_files], True
+
+    def parse_diff_log(self, diff_log, languages=[]):
+        """
+        Parse a diff log into the list of (file_name_a, file_name_b, file_diff)
+        of the non-binary, non-added files in `languages`
+        """
+        parsed_files = []
+        for log in split_diff_log(diff_log):
+            try:
+                files_diff = aggregator(parse_lines(log))
+            except:
+                continue
+            for file_diff in files_diff:
+                file_name_a, file_name_b = self.get_file_names(file_diff)
+                if file_diff["is_binary"] or len(file_diff["content"]) == 0:
+                    continue
+
+                if file_diff["from"]["mode"] == "0000000":
+                    continue
+
+                if len(languages) > 0:
+                    file_language = get_programming_language(file_name_b)
+                    if file_language not in languages:
+                        continue
+
+                parsed_files.append((file_name_a, file_name_b, file_diff))
+        return parsed_files
+
+    def get_file_names(self, file_diff):
+        """
+        Get the names of a diffed file before and after the commit
+        """
+        file_name_a = (
+            file_diff["from"]["file"]
+            if file_diff["rename"] or file_diff["from"]["mode"] != "0000000"
+            else file_diff["to"]["file"]
+        )
+        file_name_b = (
+            file_diff["to"]["file"]
+            if file_diff["rename"] or file_diff["to"]["mode"] != "0000000"
+            else file_diff["from"]["file"]
+        )
+        return file_name_a, file_name_b
+
+    def blame_files(self, parsed_files, rev: str):
+        """
+        Blame all parsed files at `rev` concurrently and keep the blamed ones.
+        In blame-free mode, all files are kept without blame.
+        """
+        if not self.blame:
+            files = [file_name_b for _, file_name_b, _ in parsed_files]
+            commit_diff = {
+                file_name_b: file_diff for _, file_name_b, file_diff in parsed_files
+            }
+            return files, commit_diff, {}
+
+        commands = [
+            ["git", "blame", "-t", "-n", "-l", rev, "--", file_name_a]
+            for file_name_a, _, _ in parsed_files
+        ]
+        blame_logs = self.get_executor().run_all(commands, cwd=self.repo.get_path())
+
+        commit_diff = {}
+        commit_blame = {}
+        files = []
+        for (_, file_name_b, file_diff), file_blame_log in zip(
+            parsed_files, blame_logs
+        ):
+            if not file_blame_log:
+                continue
+            commit_blame[file_name_b] = get_file_blame(file_blame_log)
+            commit_diff[file_name_b] = file_diff
+            files.append(file_name_b)
+        return files, commit_diff, commit_blame
+
+    def extract_one_commit_diff(
+        self, commit_id: str, languages=[], prefetched=None, canonical=None
+    ):
         """
         Input:
             commit_id: the id of the commit
+            prefetched: the result of `prefetch_one_commit`, if already started
+            canonical: an extracted commit with the same patch, whose diff is
+                reused so that only the metadata and blame are extracted
         Output:
             commit: dict of commit's information
                 |- commit_id: the id of the commit
@@ -102,10 +599,14 @@ class Extractor:
                 |- files: the list of files in the commit
                 |- diff: the dict of files diff in the commit
                 |- blame: the dict of files blame in the commit
+                |- truncated: only set to True if the size limits left files out
+                |- canonical_id: only set to the id of `canonical` if given
+            Raise `OversizedCommitError` if the commit is skipped by the size limits
         """
-        command = "git show {} --name-only --pretty=format:'%H%n%P%n%an%n%ct%n%s%n%B%n[ALL CHANGE FILES]'"
+        if prefetched is None:
+            prefetched = self.prefetch_one_commit(commit_id, languages)
 
-        show_msg = exec_cmd(command.format(commit_id))
+        show_msg = prefetched["show"].result()
         show_msg = [msg.strip() for msg in show_msg]
         file_index = show_msg.index("[ALL CHANGE FILES]")
 
@@ -118,48 +619,57 @@ class Extractor:
         commit_date = head[3]
         commit_msg = " ".join(commit_msg)
 
-        command = "git show {} --pretty=format: --unified=999999999"
-        diff_log = split_diff_log(exec_cmd(command.format(commit_id)))
-        commit_diff = {}
-        commit_blame = {}
-        files = []
-        for log in diff_log:
-            try:
-                files_diff = aggregator(parse_lines(log))
-            except:
-                continue
-            for file_diff in files_diff:
-                file_name_a = (
-                    file_diff["from"]["file"]
-                    if file_diff["rename"] or file_diff["from"]["mode"] != "0000000"
-                    else file_diff["to"]["file"]
-                )
-                file_name_b = (
-                    file_diff["to"]["file"]
-                    if file_diff["rename"] or file_diff["to"]["mode"] != "0000000"
-                    else file_diff["from"]["file"]
-                )
-                if file_diff["is_binary"] or len(file_diff["content"]) == 0:
-                    continue
-
-                if file_diff["from"]["mode"] == "0000000":
-                    continue
+        changed_files = [file for file in show_msg[file_index + 1 :] if file]
+        if canonical is not None and self.has_same_base(
+            canonical, parent_id, changed_files, prefetched["pathspecs"]
+        ):
+            return self.extract_duplicate_commit(
+                commit_id, parent_id, subject, commit_msg, author, commit_date, canonical
+            )
 
-                if len(languages) > 0:
-                    file_language = get_programming_language(file_name_b)
-                    if file_language not in languages:
-                        continue
+        truncated = False
+        if "diff" not in prefetched and "numstat" not in prefetched:
+            self.prefetch_diff(commit_id, prefetched)
+        if "diff" not in prefetched:
+            pathspecs, truncated = self.check_limits(
+                commit_id,
+                parent_id,
+                prefetched["numstat"].result(),
+                prefetched["pathspecs"],
+            )
+            if pathspecs is None:
+                raise OversizedCommitError(commit_id)
+            prefetched["diff"] = self.submit_diff(commit_id, pathspecs)
 
-                command = "git blame -t -n -l {} '{}'"
-                file_blame_log = exec_cmd(command.format(parent_id, file_name_a))
-                if not file_blame_log:
-                    continue
-                file_blame = get_file_blame(file_blame_log)
+        parsed_files = self.parse_diff_log(prefetched["diff"].result(), languages)
+        files, commit_diff, commit_blame = self.blame_files(parsed_files, parent_id)
 
-                commit_blame[file_name_b] = file_blame
-                commit_diff[file_name_b] = file_diff
-                files.append(file_name_b)
+        commit = {
+            "commit_id": commit_id,
+            "parent_id": parent_id,
+            "subject": subject,
+            "message": commit_msg,
+            "author": author,
+            "date": int(commit_date),
+            "files": files,
+            "diff": commit_diff,
+            "blame": commit_blame,
+        }
+        if truncated:
+            commit["truncated"] = True
+        return commit
 
+    def extract_duplicate_commit(
+        self, commit_id, parent_id, subject, commit_msg, author, commit_date, canonical
+    ):
+        """
+        Build a commit sharing the diff of `canonical`, blamed at its own parent
+        """
+        parsed_files = [
+            self.get_file_names(file_diff) + (file_diff,)
+            for file_diff in canonical["diff"].values()
+        ]
+        files, commit_diff, commit_blame = self.blame_files(parsed_files, parent_id)
         commit = {
             "commit_id": commit_id,
             "parent_id": parent_id,
@@ -170,52 +680,302 @@ class Extractor:
             "files": files,
             "diff": commit_diff,
             "blame": commit_blame,
+            "canonical_id": canonical["commit_id"],
         }
+        if canonical.get("truncated"):
+            commit["truncated"] = True
         return commit
 
-    def extract_repo_commit_diffs(self):
+    def has_same_base(self, canonical, parent_id, files, pathspecs):
+        """
+        Whether the changed `files` are the same in `parent_id` as in the
+        parent of `canonical`, so that its diff and line numbers still apply,
+        e.g. not for a cherry-pick onto a branch where lines were inserted
+        """
+        if canonical["parent_id"] == parent_id:
+            return True
+        if not canonical["parent_id"] or not parent_id:
+            return False
+        different_files = self.get_executor().run(
+            ["git", "diff-tree", "-r", "--name-only", canonical["parent_id"], parent_id]
+            + ["--"]
+            + pathspecs,
+            cwd=self.repo.get_path(),
+        )
+        return not set(files) & set(different_files)
+
+    def prefetch_next_commit(self, commit_ids, i, stored_ids, duplicate_ids):
+        if i >= len(commit_ids) or commit_ids[i] in stored_ids:
+            return None
+        commit_id = commit_ids[i]
+        return self.prefetch_one_commit(commit_id, diff=commit_id not in duplicate_ids)
+
+    def get_duplicate_ids(self, commit_ids):
+        """
+        Compute the patch ids of `commit_ids` and get the ones whose patch is
+        already extracted or comes earlier in `commit_ids`
+        """
+        patch_ids = get_patch_ids(
+            commit_ids,
+            get_pathspecs(self.language, self.include, self.exclude),
+            cwd=self.repo.get_path(),
+        )
+        self.commit_patch_ids = patch_ids
+        seen = set(
+            patch
+            for patch, canonical_id in self.repo.patch_ids.items()
+            if self.repo.ids.get(canonical_id, -1) >= 0
+        )
+        duplicate_ids = set()
+        for commit_id in commit_ids:
+            patch = patch_ids.get(commit_id)
+            if patch is None:
+                continue
+            if patch in seen:
+                duplicate_ids.add(commit_id)
+            seen.add(patch)
+        return duplicate_ids
+
+    def get_canonical_commit(self, commit_id):
+        """
+        Get the extracted commit with the same patch as `commit_id`, if any
+        """
+        canonical_id = self.repo.patch_ids.get(self.commit_patch_ids.get(commit_id))
+        if canonical_id is None or self.repo.ids.get(canonical_id, -1) < 0:
+            return None
+        if canonical_id in self.repo.commits:
+            return self.repo.commits[canonical_id]
+        num = self.repo.ids[canonical_id]
+        if self.canonical_shard[0] != num:
+            self.canonical_shard = (num, self.repo.read_commits(num))
+        return self.canonical_shard[1].get(canonical_id)
+
+    def extract_repo_commit_diffs(self, fetch=None):
+        """
+        Extract the diffs of the commits not extracted yet into the shards.
+        `fetch`, given the ids to extract in order, yields each id with its
+        commit or status, e.g. the commits extracted by distributed workers.
+        """
         print("Collecting commits information ...")
         if not self.num_commits_per_file:
             self.num_commits_per_file = len(self.repo.ids)
         extracting_ids = [id for id in self.repo.ids if self.repo.ids[id] == -1]
         if len(extracting_ids) == 0:
+            self.close_commit_workers()
             return
         bug_fix_ids = []
-        if self.last_file_num_commits > 0:
+        if self.save:
+            self.resume_commits()
+            extracting_ids = [id for id in extracting_ids if self.repo.ids[id] == -1]
+            if len(extracting_ids) == 0:
+                self.checkpoint(bug_fix_ids)
+                self.repo.export_bug_fix()
+                self.close_commit_workers()
+                return
+        elif self.last_file_num_commits > 0:
             self.repo.load_commits(self.num_files)
+        last_checkpoint = time.time()
 
-        for commit_id in tqdm(extracting_ids):
-            try:
-                commit = self.extract_one_commit_diff(commit_id, self.language)
-                if not commit["diff"]:
-                    self.repo.ids[commit_id] = -2
-                    continue
+        self.commit_patch_ids = {}
+        if fetch is None:
+            results = self.iter_commit_diffs(extracting_ids)
+        else:
+            results = fetch(extracting_ids)
+        self.start_commit_workers()
+        for commit_id, commit in tqdm(results, total=len(extracting_ids)):
+            if isinstance(commit, int):
+                self.repo.ids[commit_id] = commit
+            elif not commit["diff"]:
+                self.repo.ids[commit_id] = -2
+            else:
+                # commits are only pickled twice to fit a byte budget
+                num_bytes = 0
+                if self.save and self.max_shard_bytes:
+                    num_bytes = get_pkl_size(commit)
+                if self.save and self.is_shard_full(num_bytes):
+                    self.rotate_shard()
+                    self.checkpoint(bug_fix_ids)
+                    last_checkpoint = time.time()
                 self.repo.commits[commit_id] = commit
                 self.repo.ids[commit_id] = self.num_files
+                self.unsaved_ids.append(commit_id)
+                self.publish_commit(commit)
                 self.last_file_num_commits += 1
+                self.last_file_num_bytes += num_bytes
                 if check_fix(commit["message"]):
                     bug_fix_ids.append(commit_id)
-            except Exception:
-                self.repo.ids[commit_id] = -3
+                patch = self.commit_patch_ids.get(commit_id)
+                if "canonical_id" not in commit and patch is not None:
+                    self.repo.patch_ids.setdefault(patch, commit_id)
 
-            if self.last_file_num_commits == self.num_commits_per_file and self.save:
-                self.repo.save_commits(self.num_files)
-                self.last_file_num_commits = 0
-                self.num_files += 1
-                self.repo.commits = {}
+            if not self.save:
+                continue
+            if self.is_shard_full():
+                self.rotate_shard()
+                self.checkpoint(bug_fix_ids)
+                last_checkpoint = time.time()
+            elif (
+                self.checkpoint_interval
+                and time.time() - last_checkpoint >= self.checkpoint_interval
+            ):
+                self.checkpoint(bug_fix_ids, full=False)
+                last_checkpoint = time.time()
 
         if self.check_uncommit:
             uncommit = self.extract_repo_uncommit()
             if uncommit and uncommit["diff"]:
                 self.repo.uncommit["commit"] = uncommit
+        self.close_commit_workers()
 
         if self.save:
-            if self.repo.commits:
-                self.repo.save_commits(self.num_files)
-            self.repo.save_bug_fix(bug_fix_ids)
-            self.repo.save_ids()
+            self.checkpoint(bug_fix_ids)
+            self.repo.export_bug_fix()
+
+    def iter_commit_diffs(self, commit_ids):
+        """
+        Extract the diffs of `commit_ids`, in order. Get an iterator of each
+        commit id with its commit, or its status if it is not extracted.
+        """
+        duplicate_ids = set()
+        if self.dedup_patches:
+            self.canonical_shard = (None, {})
+            self.repo.load_patch_ids()
+            duplicate_ids = self.get_duplicate_ids(commit_ids)
+            print("Duplicated patches: {}".format(len(duplicate_ids)))
+
+        stored_ids = set()
+        if self.commit_store is not None:
+            options_key = self.get_store_options_key()
+            stored_ids = set(
+                id for id in commit_ids if self.commit_store.contains(id, options_key)
+            )
+            print("Stored commits: {}".format(len(stored_ids)))
+        return self.iter_prefetched_diffs(commit_ids, stored_ids, duplicate_ids)
+
+    def iter_prefetched_diffs(self, commit_ids, stored_ids, duplicate_ids):
+        options_key = self.get_store_options_key() if stored_ids else None
+        # the next commit's `git show` runs while the current one is parsed
+        next_prefetched = self.prefetch_next_commit(
+            commit_ids, 0, stored_ids, duplicate_ids
+        )
+        for i, commit_id in enumerate(commit_ids):
+            prefetched = next_prefetched
+            next_prefetched = self.prefetch_next_commit(
+                commit_ids, i + 1, stored_ids, duplicate_ids
+            )
+            try:
+                commit = None
+                if commit_id in stored_ids:
+                    commit = self.commit_store.get(
+                        self.commit_store.get_key(commit_id, options_key)
+                    )
+                if commit is None:
+                    canonical = None
+                    if commit_id in duplicate_ids:
+                        canonical = self.get_canonical_commit(commit_id)
+                    commit = self.extract_one_commit_diff(
+                        commit_id, self.language, prefetched, canonical
+                    )
+            except OversizedCommitError:
+                commit = -4
+            except TimeoutError:
+                commit = -5
+            except Exception:
+                commit = -3
+            yield commit_id, commit
+
+    def resume_commits(self):
+        """
+        Reload the partial shard left by a previous or interrupted run.
+        The commits of a shard saved by a checkpoint are not extracted again,
+        even if the run was killed before their ids were saved.
+        """
+        while os.path.exists(
+            self.repo.get_commits_path(self.num_files + 1)
+        ) or os.path.exists(self.repo.get_journal_path(self.num_files + 1)):
+            self.num_files += 1
+        self.repo.load_commits(self.num_files)
+        self.unsaved_ids = []
+        for commit_id in self.repo.commits:
+            self.repo.ids[commit_id] = self.num_files
+        self.last_file_num_commits = len(self.repo.commits)
+        self.last_file_num_bytes = self.get_resumed_shard_size()
+        if self.is_shard_full():
+            self.rotate_shard()
+
+    def is_shard_full(self, num_bytes=0):
+        """
+        Whether the current shard is full, or would exceed the byte budget with
+        a commit of `num_bytes`. A commit larger than the budget gets a shard
+        of its own.
+        """
+        if self.last_file_num_commits >= self.num_commits_per_file:
+            return True
+        return bool(
+            self.max_shard_bytes
+            and self.last_file_num_commits
+            and self.last_file_num_bytes + num_bytes > self.max_shard_bytes
+        )
+
+    def rotate_shard(self):
+        """
+        Save the current shard and start a new one
+        """
+        self.save_shard()
+        self.last_file_num_commits = 0
+        self.last_file_num_bytes = 0
+        self.num_files += 1
+        self.repo.commits = {}
+
+    def get_resumed_shard_size(self):
+        """
+        Get the pickled size of the partial shard: the size the manifest
+        recorded for its file and the size of its journal
+        """
+        shard = self.repo.load_shards().get(str(self.num_files))
+        journal_size = self.repo.get_journal_size(self.num_files)
+        if not os.path.exists(self.repo.get_commits_path(self.num_files)):
+            shard = {"num_bytes": 0}
+        # with a commit store, the journal only holds references
+        if shard and shard["num_bytes"] is not None:
+            if self.commit_store is None or not journal_size:
+                return shard["num_bytes"] + journal_size
+        if not self.max_shard_bytes:
+            return 0
+        return self.repo.get_commits_size()
 
-    def extract_one_commit_features(self, commit):
+    def save_shard(self):
+        num_bytes = self.repo.save_commits(self.num_files)
+        self.unsaved_ids = []
+        if num_bytes is None and self.max_shard_bytes:
+            num_bytes = self.last_file_num_bytes
+        self.repo.save_shard(self.num_files, num_bytes)
+
+    def checkpoint(self, bug_fix_ids, full=True):
+        """
+        Atomically save the current shard, or only append its commits added
+        since the last checkpoint to its journal if not `full`, then the bug
+        fixes found since the last checkpoint, the ids' statuses and the
+        config. `bug_fix_ids` is emptied once saved.
+        """
+        if full and self.repo.commits:
+            self.save_shard()
+        elif self.unsaved_ids:
+            commits = {id: self.repo.commits[id] for id in self.unsaved_ids}
+            self.repo.append_commits(self.num_files, commits)
+            self.unsaved_ids = []
+        self.repo.save_bug_fix(bug_fix_ids)
+        bug_fix_ids.clear()
+        if self.dedup_patches:
+            self.repo.save_patch_ids()
+        self.repo.save_ids()
+        self.save_config()
+
+    def extract_one_commit_features(self, commit, update=True):
+        """
+        Compute the features of a commit from the repository's per-file and
+        per-author state. The commit is recorded in that state only if `update`.
+        """
         commit_id = commit["commit_id"]
         commit_date = commit["date"]
         commit_message = commit["message"]
@@ -224,24 +984,24 @@ class Extractor:
         commit_blame = commit["blame"]
 
         la, ld, lt, age, nuc = (0, 0, 0, 0, 0)
-        subs, dirs, files = [], [], []
+        subs, dirs, files = set(), set(), set()
         totalLOCModified = 0
         locModifiedPerFile = []
-        authors = []
+        authors = set()
         ages = []
-        author_exp = self.repo.authors.get(commit_author, {})
-
-        for file_elem in list(commit_diff.items()):
-            file_path = file_elem[0]
-            val = file_elem[1]
+        state = self.repo.state
+        author_id = state.get_author_id(commit_author)
+        author_exp = state.author_exp[author_id]
+        if not update:
+            author_exp = {
+                path_id: array("q", times) for path_id, times in author_exp.items()
+            }
 
+        for file_path, val in commit_diff.items():
             subsystem, directory, filename = get_subs_dire_name(file_path)
-            if subsystem not in subs:
-                subs.append(subsystem)
-            if directory not in dirs:
-                dirs.append(directory)
-            if filename not in files:
-                files.append(filename)
+            subs.add(subsystem)
+            dirs.add(directory)
+            files.add(filename)
 
             result = calu_modified_lines(val)
             la += result[0]
@@ -251,28 +1011,38 @@ class Extractor:
             totalLOCModified += la + ld
             locModifiedPerFile.append(totalLOCModified)
 
-            file = self.repo.files.get(file_path, {"author": [], "nuc": 0})
-            file_author = file["author"]
-            if commit_author not in file_author:
-                file_author.append(commit_author)
-            authors = list(set(authors) | set(file_author))
+            path_id = state.get_path_id(file_path)
+            file_author = state.file_authors[path_id]
+            if file_path in commit_blame:
+                prev_time = get_prev_time(commit_blame, file_path)
+                self.update_blame_divergence(
+                    commit_date, prev_time, path_id, commit_blame[file_path]
+                )
+            else:
+                # blame-free: the last commit that changed the file
+                prev_time = state.file_time[path_id]
+
+            if update:
+                file_author.add(author_id)
+                authors |= file_author
+            else:
+                authors |= file_author
+                authors.add(author_id)
 
-            prev_time = get_prev_time(commit_blame, file_path)
             age = commit_date - prev_time if prev_time else 0
             age = max(age, 0)
             ages.append(age)
 
-            file_nuc = file["nuc"] + 1
+            file_nuc = state.file_nuc[path_id] + 1
             nuc += file_nuc
+            if update:
+                state.file_nuc[path_id] = file_nuc
+                state.file_time[path_id] = commit_date
 
-            file["nuc"] = file_nuc
-            self.repo.files[file_path] = file
-
-            if file_path in author_exp:
-                author_exp[file_path].append(commit_date)
+            if path_id in author_exp:
+                author_exp[path_id].append(commit_date)
             else:
-                author_exp[file_path] = [commit_date]
-            self.repo.authors[commit_author] = author_exp
+                author_exp[path_id] = array("q", [commit_date])
 
         feature = {
             "_id": commit_id,
@@ -290,94 +1060,222 @@ class Extractor:
             "nuc": nuc,
             "exp": get_author_exp(author_exp),
             "rexp": get_author_rexp(author_exp, commit_date),
-            "sexp": get_author_sexp(author_exp, subs),
+            "sexp": state.get_author_sexp(author_exp, subs),
         }
         return feature
 
+    def update_blame_divergence(self, commit_date, blame_time, path_id, file_blame):
+        """
+        Compare the blame-based age and authors of a file with the ones
+        derived from the replayed history, as blame-free mode would use them
+        """
+        if self.blame_divergence is None:
+            return
+        state_time = self.repo.state.file_time[path_id]
+        blame_age = max(commit_date - blame_time, 0) if blame_time else 0
+        state_age = max(commit_date - state_time, 0) if state_time else 0
+        blame_authors = set(info["author"] for info in file_blame.values())
+        state_authors = self.repo.state.get_file_author_names(path_id)
+        union = blame_authors | state_authors
+        jaccard = len(blame_authors & state_authors) / len(union) if union else 1
+
+        divergence = self.blame_divergence
+        divergence["num_files"] += 1
+        divergence["num_equal_ages"] += int(blame_age == state_age)
+        divergence["age_mean_abs_error"] += (
+            abs(blame_age - state_age) / 86400 - divergence["age_mean_abs_error"]
+        ) / divergence["num_files"]
+        divergence["author_mean_jaccard"] += (
+            jaccard - divergence["author_mean_jaccard"]
+        ) / divergence["num_files"]
+
+    def get_num_commit_files(self):
+        return self.num_files if self.last_file_num_commits == 0 else self.num_files + 1
+
+    def iter_replay_commits(self):
+        """
+        Iterate over the extracted commits in replay order
+        """
+        for num in range(self.get_num_commit_files()):
+            self.repo.load_commits(num)
+            yield from self.repo.commits.values()
+        self.repo.commits = {}
+
+    def extract_repo_commits_features_bulk(self):
+        """
+        Compute all features with the BulkFeatureEngine. The uncommit is
+        replayed last, which leaves the commits' features unchanged. No
+        per-file state is kept, so a state saved by a previous run is removed.
+        """
+        from .Features import BulkFeatureEngine
+
+        print("Extracting features in bulk ...")
+        commits = self.iter_replay_commits()
+        uncommit = None
+        if self.check_uncommit and self.repo.uncommit and self.repo.uncommit["commit"]:
+            uncommit = self.repo.uncommit["commit"]
+            commits = itertools.chain(commits, [uncommit])
+        features = BulkFeatureEngine().compute(commits)
+        if uncommit is not None:
+            self.repo.uncommit["feature"] = features.pop(uncommit["commit_id"])
+        self.repo.features = features
+        if self.save:
+            self.repo.save_features()
+            if os.path.exists(self.repo.paths["state"]):
+                os.remove(self.repo.paths["state"])
+
+    def compare_feature_engines(self):
+        """
+        Compute the features with both engines and get the mismatching
+        (commit id, feature) pairs
+        """
+        from .Features import compare_features
+
+        save = self.save
+        self.save = False
+        self.extract_repo_commits_features_bulk()
+        bulk_features = self.repo.features
+        bulk_uncommit = self.repo.uncommit.get("feature")
+        self.extract_repo_commits_features_loop()
+        self.save = save
+        mismatches = compare_features(self.repo.features, bulk_features)
+        if bulk_uncommit is not None:
+            mismatches += compare_features(
+                {"uncommit": self.repo.uncommit["feature"]},
+                {"uncommit": bulk_uncommit},
+            )
+        print(
+            "Feature engines: {} mismatches over {} commits".format(
+                len(mismatches), len(self.repo.features)
+            )
+        )
+        return mismatches
+
     def extract_repo_commits_features(self):
+        if self.validate_features:
+            mismatches = self.compare_feature_engines()
+            assert not mismatches, "Feature engines mismatch: {}".format(
+                mismatches[:10]
+            )
+        if self.feature_engine == "bulk":
+            self.extract_repo_commits_features_bulk()
+        else:
+            self.extract_repo_commits_features_loop()
+
+    def extract_repo_commits_features_loop(self, commits=None):
+        """
+        Replay the extracted commits, or `commits` in replay order, e.g. the
+        stream of a commit worker
+        """
         print("Extracting features ...")
-        self.repo.files = {}
-        self.repo.authors = {}
+        self.repo.state = FeatureState()
         self.repo.features = {}
+        self.blame_divergence = {
+            "num_files": 0,
+            "num_equal_ages": 0,
+            "age_mean_abs_error": 0,
+            "author_mean_jaccard": 0,
+        }
 
-        num_file = (
-            self.num_files if self.last_file_num_commits == 0 else self.num_files + 1
-        )
-        for num in range(num_file):
-            self.repo.load_commits(num)
-            for commit_id in tqdm(self.repo.commits):
-                commit_feature = self.extract_one_commit_features(
-                    self.repo.commits[commit_id]
-                )
-                self.repo.features[commit_id] = commit_feature
+        if commits is None:
+            for num in range(self.get_num_commit_files()):
+                self.repo.load_commits(num)
+                for commit_id in tqdm(self.repo.commits):
+                    commit_feature = self.extract_one_commit_features(
+                        self.repo.commits[commit_id]
+                    )
+                    self.repo.features[commit_id] = commit_feature
+        else:
+            for commit in commits:
+                commit_feature = self.extract_one_commit_features(commit)
+                self.repo.features[commit["commit_id"]] = commit_feature
         if self.check_uncommit:
             if self.repo.uncommit and self.repo.uncommit["commit"]:
                 commit_feature = self.extract_one_commit_features(
-                    self.repo.uncommit["commit"]
+                    self.repo.uncommit["commit"], update=False
                 )
                 self.repo.uncommit["feature"] = commit_feature
+        if self.blame_divergence["num_files"]:
+            print(
+                "Blame-free divergence: {num_equal_ages}/{num_files} equal ages, "
+                "age mean absolute error: {age_mean_abs_error:.2f} days, "
+                "author mean Jaccard: {author_mean_jaccard:.3f}".format(
+                    **self.blame_divergence
+                )
+            )
+        else:
+            self.blame_divergence = None
         if self.save:
             self.repo.save_features()
-        self.repo.files = {}
-        self.repo.authors = {}
+            self.repo.save_state()
+        self.repo.state = FeatureState()
 
     def extract_repo_uncommit(self):
+        repo_path = self.repo.get_path()
+        # a bare repository has no working tree to diff
+        if is_bare_repo(repo_path):
+            return None
         command = "git config --get user.name"
-        author = exec_cmd(command)[0]
+        author = exec_cmd(command, cwd=repo_path)
+        # e.g. in containers and CI checkouts, where no user is configured
+        author = author[0] if author else ""
 
         command = "git show HEAD --name-only --pretty=format:'%H'"
-        HEAD = exec_cmd(command)[0]
+        HEAD = exec_cmd(command, cwd=repo_path)[0]
 
-        command = "git diff --pretty=format: --unified=999999999"
-        diff_log = exec_cmd(command)
+        command = ["git", "diff", "--pretty=format:", "--unified=999999999", "--"]
+        command += get_pathspecs(self.repo.language, self.include, self.exclude)
+        diff_log = self.get_executor().run(command, cwd=repo_path)
         if diff_log == []:
             return None
-        diff_log = split_diff_log(exec_cmd(command))
-        commit_diff = {}
-        commit_blame = {}
-        files = []
-        languages = self.repo.language
-        for log in diff_log:
-            try:
-                files_diff = aggregator(parse_lines(log))
-            except:
-                continue
-            for file_diff in files_diff:
-                file_name_a = (
-                    file_diff["from"]["file"]
-                    if file_diff["rename"] or file_diff["from"]["mode"] != "0000000"
-                    else file_diff["to"]["file"]
-                )
-                file_name_b = (
-                    file_diff["to"]["file"]
-                    if file_diff["rename"] or file_diff["to"]["mode"] != "0000000"
-                    else file_diff["from"]["file"]
-                )
-                if file_diff["is_binary"] or len(file_diff["content"]) == 0:
-                    continue
-
-                if file_diff["from"]["mode"] == "0000000":
-                    continue
-
-                file_language = get_programming_language(file_name_b)
-                if file_language not in languages:
-                    continue
+        return self.extract_patch(diff_log, author, HEAD)
 
-                command = "git blame -t -n -l {} '{}'"
-                file_blame_log = exec_cmd(command.format(HEAD, file_name_a))
-                if not file_blame_log:
-                    continue
-                file_blame = get_file_blame(file_blame_log)
+    def expand_patch(self, patch, parent_id):
+        """
+        Apply a patch, e.g. the output of `git diff`, on `parent_id` in a
+        temporary index and get its diff log with the whole files as context,
+        as extracted commits have. Raise `ValueError` if it does not apply.
+        """
+        repo_path = self.repo.get_path()
+        with tempfile.TemporaryDirectory() as index_dir:
+            env = dict(os.environ, GIT_INDEX_FILE=os.path.join(index_dir, "index"))
+            commands = [
+                (["git", "read-tree", parent_id], None),
+                (["git", "apply", "--cached", "-"], patch.encode()),
+                (
+                    ["git", "diff", "--cached", "--pretty=format:"]
+                    + ["--unified=999999999", parent_id, "--"]
+                    + get_pathspecs(self.repo.language, self.include, self.exclude),
+                    None,
+                ),
+            ]
+            for command, stdin in commands:
+                result = subprocess.run(
+                    command, input=stdin, capture_output=True, cwd=repo_path, env=env
+                )
+                if result.returncode != 0:
+                    raise ValueError(
+                        "Cannot apply the patch on {}: {}".format(
+                            parent_id, result.stderr.decode(errors="replace").strip()
+                        )
+                    )
+        return decode_output(result.stdout)
 
-                commit_blame[file_name_b] = file_blame
-                commit_diff[file_name_b] = file_diff
-                files.append(file_name_b)
+    def extract_patch(
+        self, diff_log, author, parent_id, commit_id="uncommit", message=""
+    ):
+        """
+        Build a commit from a diff log applied on `parent_id`, e.g. the working
+        tree or a patch to score
+        """
+        parsed_files = self.parse_diff_log(diff_log, self.repo.language)
+        files, commit_diff, commit_blame = self.blame_files(parsed_files, parent_id)
 
         commit = {
-            "commit_id": "uncommit",
-            "parent_id": HEAD,
+            "commit_id": commit_id,
+            "parent_id": parent_id,
             "subject": None,
-            "message": "",
+            "message": message,
             "author": author,
             "date": int(datetime.datetime.now().timestamp()),
             "files": files,
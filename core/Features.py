@@ -0,0 +1,216 @@
+from utils import calu_modified_lines, check_fix, get_path_metadata, get_prev_time
+import numpy as np
+import pandas as pd
+
+INT_FEATURES = ["date", "ns", "nd", "nf", "la", "ld", "lt", "fix", "ndev", "nuc"]
+INT_FEATURES += ["exp", "sexp"]
+FLOAT_FEATURES = ["entropy", "age", "rexp"]
+REXP_BLOCK_SIZE = 64
+
+
+class BulkFeatureEngine:
+    def __init__(self):
+        """
+        Compute the features of all the commits of a repository at once.
+        The commits are exploded into one row per changed file, in replay
+        order, and every feature is a groupby, cumulative count or window over
+        that table. The values match Extractor.extract_one_commit_features,
+        quirks included, up to floating point summation order.
+        """
+        self.commits = None
+        self.changes = None
+
+    def build_frames(self, commits):
+        """
+        Explode `commits`, an iterable of commits in replay order, into a
+        commit table and a file-change table
+        """
+        commit_rows = {"_id": [], "date": [], "author": [], "fix": []}
+        change_rows = {
+            "c": [],
+            "path": [],
+            "sub": [],
+            "dir": [],
+            "file": [],
+            "added": [],
+            "deleted": [],
+            "lines": [],
+            "blame_time": [],
+        }
+        for c, commit in enumerate(commits):
+            commit_rows["_id"].append(commit["commit_id"])
+            commit_rows["date"].append(commit["date"])
+            commit_rows["author"].append(commit["author"])
+            commit_rows["fix"].append(check_fix(commit["message"]))
+            commit_blame = commit["blame"]
+            for file_path, val in commit["diff"].items():
+                subsystem, directory, filename, _ = get_path_metadata(file_path)
+                added, deleted, lines = calu_modified_lines(val)
+                change_rows["c"].append(c)
+                change_rows["path"].append(file_path)
+                change_rows["sub"].append(subsystem)
+                change_rows["dir"].append(directory)
+                change_rows["file"].append(filename)
+                change_rows["added"].append(added)
+                change_rows["deleted"].append(deleted)
+                change_rows["lines"].append(lines)
+                change_rows["blame_time"].append(
+                    get_prev_time(commit_blame, file_path)
+                    if file_path in commit_blame
+                    else np.nan
+                )
+
+        self.commits = pd.DataFrame(commit_rows)
+        self.commits["author"] = pd.factorize(self.commits["author"])[0]
+        changes = pd.DataFrame(change_rows)
+        changes["c"] = changes["c"].astype(np.int64)
+        changes["date"] = self.commits["date"].to_numpy()[changes["c"]]
+        changes["author"] = self.commits["author"].to_numpy()[changes["c"]]
+        self.changes = changes
+
+    def compute(self, commits):
+        """
+        Get the features of `commits` keyed by commit id
+        """
+        self.build_frames(commits)
+        C, F = self.commits, self.changes
+        index = pd.RangeIndex(len(C))
+        by_commit = F.groupby("c", sort=True)
+
+        features = pd.DataFrame({"_id": C["_id"], "date": C["date"]}, index=index)
+        counts = by_commit[["sub", "dir", "file"]].nunique()
+        features["ns"] = counts["sub"]
+        features["nd"] = counts["dir"]
+        features["nf"] = counts["file"]
+        features["entropy"] = self.get_entropy(F)
+        sums = by_commit[["added", "deleted", "lines"]].sum()
+        features["la"] = sums["added"]
+        features["ld"] = sums["deleted"]
+        features["lt"] = sums["lines"]
+        features["fix"] = C["fix"]
+        features["ndev"] = self.get_ndev(F)
+        features["age"] = self.get_age(F)
+        features["nuc"] = (F.groupby("path", sort=False).cumcount() + 1).groupby(
+            F["c"]
+        ).sum()
+        exp, rexp = self.get_exp(C, F)
+        features["exp"] = exp
+        features["rexp"] = rexp
+        features["sexp"] = self.get_sexp(C, F)
+
+        features = features.fillna(0)
+        for key in INT_FEATURES:
+            features[key] = features[key].astype(np.int64)
+        for key in FLOAT_FEATURES:
+            features[key] = features[key].astype(np.float64)
+        return {
+            feature["_id"]: feature for feature in features.to_dict("records")
+        }
+
+    def get_entropy(self, F):
+        """
+        The per-file values are the running totals of the commit's running
+        modified lines, as in calc_entropy's callers
+        """
+        running = (F["added"] + F["deleted"]).groupby(F["c"]).cumsum()
+        loc = running.groupby(F["c"]).cumsum()
+        total = loc.groupby(F["c"]).transform("last")
+        ratio = (loc / total.where(total != 0)).where(loc != 0)
+        return (-ratio * np.log2(ratio)).fillna(0).groupby(F["c"]).sum()
+
+    def get_age(self, F):
+        """
+        The previous change of a file is given by its blame, or else by the
+        last replayed commit that changed it
+        """
+        last_time = F.groupby("path", sort=False)["date"].shift().fillna(0)
+        prev_time = F["blame_time"].fillna(last_time)
+        age = np.where(prev_time != 0, np.maximum(F["date"] - prev_time, 0), 0)
+        return pd.Series(age, index=F.index).groupby(F["c"]).mean() / 86400
+
+    def get_ndev(self, F):
+        """
+        Count the authors that changed any file of the commit up to the commit
+        """
+        first = F.drop_duplicates(["path", "author"])[["path", "author", "c"]]
+        pairs = F[["c", "path"]].merge(first, on="path", suffixes=("", "_first"))
+        pairs = pairs[pairs["c_first"] <= pairs["c"]]
+        return pairs.drop_duplicates(["c", "author"]).groupby("c").size()
+
+    def get_exp(self, C, F):
+        """
+        The experience skips the changes of the first file the author changed,
+        like get_author_exp and get_author_rexp
+        """
+        first_path = F.drop_duplicates("author").set_index("author")["path"]
+        is_first = F["path"].to_numpy() == first_path.reindex(F["author"]).to_numpy()
+
+        num_changes = pd.Series(1 - is_first, index=F.index).groupby(F["c"]).sum()
+        num_changes = num_changes.reindex(C.index, fill_value=0)
+        exp = num_changes.groupby(C["author"]).cumsum()
+
+        # the changes of a commit share its date: weight each commit by its count
+        rexp = np.zeros(len(C))
+        changes = num_changes[num_changes > 0]
+        change_groups = {
+            author: (group.index.to_numpy(), group.to_numpy(np.float64))
+            for author, group in changes.groupby(C["author"], sort=False)
+        }
+        dates = C["date"].to_numpy(np.float64)
+        for author, group in C.groupby("author", sort=False):
+            if author not in change_groups:
+                continue
+            change_c, weights = change_groups[author]
+            times = dates[change_c]
+            commit_c = group.index.to_numpy()
+            ends = np.searchsorted(change_c, commit_c, side="right")
+            for i in range(0, len(commit_c), REXP_BLOCK_SIZE):
+                block_c = commit_c[i : i + REXP_BLOCK_SIZE]
+                block_ends = ends[i : i + REXP_BLOCK_SIZE]
+                end = block_ends[-1]
+                age = (dates[block_c, None] - times[None, :end]) / 86400
+                values = weights[:end] / (np.maximum(age, 0) + 1)
+                values[np.arange(end)[None, :] >= block_ends[:, None]] = 0
+                rexp[block_c] = values.sum(axis=1)
+        return exp, rexp
+
+    def get_sexp(self, C, F):
+        """
+        Count the files changed by the author, up to the commit, in the
+        commit's subsystems
+        """
+        events = F.drop_duplicates(["author", "path"])[["author", "sub", "c"]]
+        queries = F.drop_duplicates(["c", "sub"])[["author", "sub", "c"]]
+        table = pd.concat(
+            [events.assign(kind=0), queries.assign(kind=1)], ignore_index=True
+        )
+        table = table.sort_values(["author", "sub", "c", "kind"], kind="stable")
+        table["count"] = (
+            (table["kind"] == 0).astype(np.int64).groupby(
+                [table["author"], table["sub"]]
+            ).cumsum()
+        )
+        queries = table[table["kind"] == 1]
+        return queries.groupby("c")["count"].sum()
+
+
+def compare_features(expected, actual, rtol=1e-9):
+    """
+    Get the (commit id, feature) pairs whose values differ between two
+    feature dicts
+    """
+    mismatches = []
+    for commit_id, feature in expected.items():
+        other = actual.get(commit_id)
+        if other is None:
+            mismatches.append((commit_id, None))
+            continue
+        for key, value in feature.items():
+            if key == "_id":
+                continue
+            if not np.isclose(value, other.get(key, np.nan), rtol=rtol, atol=1e-12):
+                mismatches.append((commit_id, key))
+    for commit_id in actual:
+        if commit_id not in expected:
+            mismatches.append((commit_id, None))
+    return mismatches
@@ -1,7 +1,11 @@
 import logging
 import os
 import yaml
-from utils import exec_cmd, load_json, LANG2EXT
+from utils import check_fix, exec_cmd, iter_json_array, load_json, save_json
+from utils import LANG2EXT
+from bisect import bisect_right
+
+OUTPUT_INDEX = "output_index.json"
 
 
 class PySZZ:
@@ -13,17 +17,23 @@ class PySZZ:
         keep_output: int = 50,
     ):
         """
-        Wrapper for PySZZ from https://github.com/grosa1/pyszz_v2
+        Wrapper for PySZZ from https://github.com/grosa1/pyszz_v2.
+        The path and configuration are checked on first use, so that stages
+        not running PySZZ do not need it.
         """
-        assert os.path.exists(pyszz_path), "PySZZ: Path not found: {}".format(
-            pyszz_path
-        )
         self.path = os.path.abspath(pyszz_path)
         self.log_path = os.path.abspath(log_path)
-        self.set_conf(pyszz_conf)
+        self.conf = pyszz_conf
+        self.base_conf = None
         self.keep_output = keep_output
 
+    def check_path(self):
+        assert os.path.exists(self.path), "PySZZ: Path not found: {}".format(
+            self.path
+        )
+
     def set_conf(self, conf="bszz"):
+        self.check_path()
         valid_conf = list(
             map(lambda x: x[:-4], os.listdir(os.path.join(self.path, "conf")))
         )
@@ -39,12 +49,12 @@ class PySZZ:
             format="%(asctime)s %(message)s",
             filemode="w",
         )
-        cur_dir = os.getcwd()
-        os.chdir(self.path)
-        
+        if self.base_conf is None:
+            self.set_conf(self.conf)
         # create output folder in case it doesn't exist
         if "out" not in os.listdir(self.path):
-            os.mkdir("out")
+            os.mkdir(os.path.join(self.path, "out"))
+        previous_outputs = self.get_output_mtimes()
 
         # modify config file
         conf = self.base_conf
@@ -59,20 +69,48 @@ class PySZZ:
         # run pyszz
         cmd = "python3 main.py {} {} {}".format(bug_fix_path, szz_conf_path, repo_path)
         logging.debug(cmd)
-        out = exec_cmd(cmd)
+        out = exec_cmd(cmd, cwd=self.path)
         logging.debug(out)
 
+        # index the new output
+        new_outputs = [
+            file
+            for file, mtime in self.get_output_mtimes().items()
+            if previous_outputs.get(file) != mtime
+        ]
+        self.update_index(new_outputs)
+
         # remove historical output
         self.remove_historical_output()
-        
-        os.chdir(cur_dir)
-        
+
+    def label(self, repo):
+        """
+        Run PySZZ on a repository and stream its output records
+        """
+        self.run(
+            repo.get_bug_fix_path(),
+            repo.get_pyszz_conf_path(self.conf),
+            repo.get_repo_path(),
+            repo.get_language(),
+        )
+        info = self.get_lastest_output_info(repo.owner, repo.name)
+        print("PySZZ output: {}".format(info["count"]))
+        return self.iter_lastest_output(repo.owner, repo.name)
+
+    def load_output(self, repo):
+        """
+        Stream the records of the latest output of a repository, labeled by
+        a previous run
+        """
+        return self.iter_lastest_output(repo.owner, repo.name)
+
     def get_outputs(self):
+        self.check_path()
         assert "out" in os.listdir(self.path), "PySZZ: No output folder"
         output_files = [
             file
             for file in os.listdir(os.path.join(self.path, "out"))
-            if self.conf in file
+            if self.conf in file and file != OUTPUT_INDEX
         ]
 
         sorted_output_files = sorted(
@@ -82,17 +120,214 @@ class PySZZ:
         )
         return sorted_output_files
 
+    def get_output_path(self, file):
+        return os.path.join(self.path, "out", file)
+
+    def get_output_mtimes(self):
+        return {
+            file: os.path.getmtime(self.get_output_path(file))
+            for file in self.get_outputs()
+        }
+
+    def load_index(self):
+        """
+        The index maps each configuration and repository to its latest output:
+        {conf: {repo_name: {"file": file, "mtime": mtime, "count": count}}}
+        """
+        return load_json(self.get_output_path(OUTPUT_INDEX))
+
+    def update_index(self, files):
+        """
+        Stream each output file once to record its repository and size
+        """
+        index = self.load_index()
+        conf_index = index.setdefault(self.conf, {})
+        for file in files:
+            repo_name = None
+            count = 0
+            for record in iter_json_array(self.get_output_path(file)):
+                if repo_name is None:
+                    repo_name = record["repo_name"]
+                count += 1
+            if repo_name is None:
+                continue
+            mtime = os.path.getmtime(self.get_output_path(file))
+            if repo_name in conf_index and conf_index[repo_name]["mtime"] > mtime:
+                continue
+            conf_index[repo_name] = {"file": file, "mtime": mtime, "count": count}
+        save_json(index, self.get_output_path(OUTPUT_INDEX))
+        return conf_index
+
+    def get_lastest_output_info(self, repo_owner, repo_name):
+        repo_name = os.path.join(repo_owner, repo_name)
+        info = self.load_index().get(self.conf, {}).get(repo_name)
+        if info:
+            path = self.get_output_path(info["file"])
+            if os.path.exists(path) and os.path.getmtime(path) == info["mtime"]:
+                return info
+        # outputs not indexed yet: only read the first record of each
+        for file in self.get_outputs():
+            first = next(iter_json_array(self.get_output_path(file)), None)
+            if first and first["repo_name"] == repo_name:
+                return self.update_index([file])[repo_name]
+        raise FileNotFoundError("PySZZ: No output found for {}".format(repo_name))
+
+    def iter_lastest_output(self, repo_owner, repo_name):
+        """
+        Stream the records of the latest output of a repository
+        """
+        info = self.get_lastest_output_info(repo_owner, repo_name)
+        return iter_json_array(self.get_output_path(info["file"]))
+
     def get_lastest_output(self, repo_owner, repo_name):
-        output_files = self.get_outputs()
-        for file in output_files:
-            data = load_json(os.path.join(self.path, "out", file))
-            if data[0]["repo_name"] == os.path.join(repo_owner, repo_name):    
-                return data
-        raise FileNotFoundError("PySZZ: No output found for {}/{}".format(repo_owner, repo_name))
-    
+        return list(self.iter_lastest_output(repo_owner, repo_name))
+
     def remove_historical_output(self):
         output_files = self.get_outputs()
         if len(output_files) > self.keep_output:
             print("Removing historical output")
             for file in output_files[self.keep_output:]:
                 os.remove(os.path.join(self.path, "out", file))
+            index = self.load_index()
+            for conf_index in index.values():
+                for repo_name in list(conf_index):
+                    if conf_index[repo_name]["file"] in output_files[self.keep_output:]:
+                        del conf_index[repo_name]
+            save_json(index, self.get_output_path(OUTPUT_INDEX))
+
+
+class BSZZ:
+    def __init__(self, save: bool = True):
+        """
+        In-process B-SZZ: the commits inducing a bug fix are the commits that
+        last changed the lines the fix deletes. The lines are mapped with the
+        diffs and parent blames already stored by the Extractor, so no git
+        command, srcML or PySZZ checkout is needed.
+        """
+        self.conf = "bszz"
+        self.save = save
+        self.boundary_ids = {}
+
+    def get_deleted_lines(self, file_diff):
+        """
+        Get the line numbers, in the parent's file, of the deleted lines
+        """
+        deleted_lines = []
+        line_a = 1
+        for hunk in file_diff["content"]:
+            if "ab" in hunk:
+                line_a += len(hunk["ab"])
+            if "a" in hunk:
+                deleted_lines.extend(range(line_a, line_a + len(hunk["a"])))
+                line_a += len(hunk["a"])
+        return deleted_lines
+
+    def get_line_owners(self, file_blame):
+        """
+        Sort the blamed ranges of a file to look lines up by bisection
+        """
+        ranges = []
+        for blame_id, info in file_blame.items():
+            for blame_range in info["ranges"]:
+                ranges.append((blame_range["start"], blame_range["end"], blame_id))
+        ranges.sort()
+        return [r[0] for r in ranges], ranges
+
+    def get_boundary_id(self, repo, blame_id):
+        """
+        Get the full id of a boundary commit, e.g. a root commit, which
+        `git blame -l` prints as `^` and the first 39 characters of its id
+        """
+        prefix = blame_id.lstrip("^")
+        if prefix not in self.boundary_ids:
+            if not repo.ids:
+                repo.load_ids()
+            matches = [id for id in repo.ids if id.startswith(prefix)]
+            if len(matches) != 1 and os.path.exists(repo.get_path()):
+                # e.g. a commit older than --extractor_start
+                matches = exec_cmd(
+                    "git rev-parse --verify --quiet {}^{{commit}}".format(prefix),
+                    cwd=repo.get_path(),
+                )
+            self.boundary_ids[prefix] = matches[0] if len(matches) == 1 else prefix
+        return self.boundary_ids[prefix]
+
+    def label_one_commit(self, commit, repo=None):
+        """
+        Get the ids of the commits inducing the bug fixed by `commit`. The
+        ids of boundary commits are completed from `repo`.
+        """
+        inducing_ids = set()
+        for file in commit["files"]:
+            if file not in commit["blame"]:
+                continue
+            starts, ranges = self.get_line_owners(commit["blame"][file])
+            for line in self.get_deleted_lines(commit["diff"][file]):
+                i = bisect_right(starts, line) - 1
+                if i >= 0 and ranges[i][0] <= line <= ranges[i][1]:
+                    blame_id = ranges[i][2]
+                    if blame_id.startswith("^") and repo is not None:
+                        blame_id = self.get_boundary_id(repo, blame_id)
+                    inducing_ids.add(blame_id.lstrip("^"))
+        return sorted(inducing_ids)
+
+    def run(self, repo, commits=None):
+        """
+        Label the extracted bug fixes, or the bug fixes among `commits`, the
+        stream of the extracted commits in replay order, e.g. while they are
+        extracted
+        """
+        repo_name = os.path.join(repo.owner, repo.name)
+        self.boundary_ids = {}
+        if commits is None:
+            commits = self.iter_bug_fix_commits(repo)
+        else:
+            commits = (commit for commit in commits if check_fix(commit["message"]))
+        output = []
+        for commit in commits:
+            assert commit["blame"] or not commit["diff"], (
+                "BSZZ: commit {} has no blame data".format(commit["commit_id"])
+            )
+            output.append(
+                {
+                    "repo_name": repo_name,
+                    "fix_commit_hash": commit["commit_id"],
+                    "inducing_commit_hash": self.label_one_commit(commit, repo),
+                }
+            )
+        if self.save:
+            save_json(output, repo.get_szz_output_path(self.conf))
+        return output
+
+    def iter_bug_fix_commits(self, repo):
+        """
+        Read the extracted bug fixes, from the commits files storing them
+        """
+        if not repo.ids:
+            repo.load_ids()
+        fix_ids = repo.load_bug_fix()
+        file_nums = sorted(
+            set(repo.ids[id] for id in fix_ids if id in repo.ids and repo.ids[id] >= 0)
+        )
+        for file_num in file_nums:
+            repo.load_commits(file_num)
+            for commit_id, commit in repo.commits.items():
+                if commit_id in fix_ids:
+                    yield commit
+        repo.commits = {}
+
+    def label(self, repo):
+        """
+        Label a repository and return its output records
+        """
+        output = self.run(repo)
+        print("BSZZ output: {}".format(len(output)))
+        return output
+
+    def load_output(self, repo):
+        """
+        Load the output saved by a previous run
+        """
+        path = repo.get_szz_output_path(self.conf)
+        assert os.path.exists(path), "BSZZ: No output found: {}".format(path)
+        return load_json(path)
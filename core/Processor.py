@@ -1,17 +1,33 @@
 from .Repository import Repository
 from .Dict import create_dict
-from utils import save_pkl, split_sentence
+from utils import load_pkl, save_pkl, split_sentence
 from datetime import datetime
+from functools import lru_cache
 import time
+import sys
 import pandas as pd
 import numpy as np
 import os
 
+LINE_CACHE_SIZE = 1 << 18
+
+
+def tokenize_line(line):
+    """
+    Tokenize and lowercase a diff line. Equal lines share one interned string.
+    """
+    return sys.intern(split_sentence(line.strip()).lower())
+
 
 class Processor:
-    def __init__(self, save_path: str, save: bool = True):
+    def __init__(
+        self, save_path: str, save: bool = True, line_cache_size: int = LINE_CACHE_SIZE
+    ):
         self.path = os.path.abspath(save_path)
         self.save = save
+        # the same lines (braces, imports, license headers) come back in many
+        # commits: memoize their tokenization, `line_cache_size=0` disables it
+        self.tokenize_line = lru_cache(maxsize=line_cache_size)(tokenize_line)
 
     def set_repo(self, repo: Repository):
         self.repo = repo
@@ -25,6 +41,13 @@ class Processor:
         self.deepjit_codes = None
         self.simcom_codes = None
         self.labels = None
+        self.tokenize_line.cache_clear()
+
+    def get_line_cache_info(self):
+        """
+        Get the hits, misses, maximum size and current size of the line cache
+        """
+        return self.tokenize_line.cache_info()
 
     def run(self, szz_output, extracted_date):
         self.create_dirs()
@@ -59,20 +82,21 @@ class Processor:
 
     def process_szz_output(self, szz_output):
         """
-        Process szz output to get bug ids
+        Process szz output, a list or a stream of records, to get bug ids
         """
         szz_bug_ids = {}
-        if szz_output:
-            repo_name = szz_output[0]["repo_name"]
-            assert repo_name == os.path.join(
-                self.repo.owner, self.repo.name
-            ), f"Unmatch szz output vs repo's info: got {repo_name} and {self.repo.owner}/{self.repo.name}"
-            for out in szz_output:
-                if out["inducing_commit_hash"]:
-                    for id in out["inducing_commit_hash"]:
-                        if id not in szz_bug_ids:
-                            szz_bug_ids[id] = []
-                        szz_bug_ids[id].append(out["fix_commit_hash"])
+        repo_name = None
+        for out in szz_output or []:
+            if repo_name is None:
+                repo_name = out["repo_name"]
+                assert repo_name == os.path.join(
+                    self.repo.owner, self.repo.name
+                ), f"Unmatch szz output vs repo's info: got {repo_name} and {self.repo.owner}/{self.repo.name}"
+            if out["inducing_commit_hash"]:
+                for id in out["inducing_commit_hash"]:
+                    if id not in szz_bug_ids:
+                        szz_bug_ids[id] = []
+                    szz_bug_ids[id].append(out["fix_commit_hash"])
         return szz_bug_ids
 
     def process_features(self, bug_ids, cols=[], time_upper_limit=None):
@@ -176,6 +200,13 @@ class Processor:
                 self.simcom_codes.append(simcom_commit)
                 self.labels.append(label)
                 del commit, id, mes, cc2vec_commit, deepjit_commit, simcom_commit, label
+        info = self.get_line_cache_info()
+        if info.hits + info.misses:
+            print(
+                "Line cache: {} hits, {} misses ({:.1%} hit rate)".format(
+                    info.hits, info.misses, info.hits / (info.hits + info.misses)
+                )
+            )
         self.code_dict = create_dict(self.messages, self.deepjit_codes)
 
     def process_one_commit(self, commit):
@@ -193,17 +224,13 @@ class Processor:
                     continue
                 if "a" in hunk:
                     for line in hunk["a"]:
-                        line = line.strip()
-                        line = split_sentence(line)
-                        line = " ".join(line.split(" ")).lower()
+                        line = self.tokenize_line(line)
                         if len(cc2vec_file["removed_code"]) <= 10:
                             cc2vec_file["removed_code"].append(line)
                         deepjit_commit.append(line)
                 if "b" in hunk:
                     for line in hunk["b"]:
-                        line = line.strip()
-                        line = split_sentence(line)
-                        line = " ".join(line.split(" ")).lower()
+                        line = self.tokenize_line(line)
                         if len(cc2vec_file["added_code"]) <= 10:
                             cc2vec_file["added_code"].append(line)
                         deepjit_commit.append(line)
@@ -216,25 +243,45 @@ class Processor:
             simcom_commit.append(f"{added_code} {removed_code}")
         return id, mes, cc2vec_commit, deepjit_commit, simcom_commit
 
+    def get_dataset_paths(self):
+        return {
+            "features": os.path.join(self.feature_path, "features.csv"),
+            "dict": os.path.join(self.commit_path, "dict.pkl"),
+            "cc2vec": os.path.join(self.commit_path, "cc2vec.pkl"),
+            "deepjit": os.path.join(self.commit_path, "deepjit.pkl"),
+            "simcom": os.path.join(self.commit_path, "simcom.pkl"),
+        }
+
     def to_dataset(self):
         """
         Save processed data to dataset
         """
-        self.df.to_csv(
-            os.path.join(self.feature_path, "features.csv"),
-            index=False,
-        )
+        paths = self.get_dataset_paths()
+        self.df.to_csv(paths["features"], index=False)
         code_msg_dict = create_dict(self.messages, self.deepjit_codes)
-        save_pkl(code_msg_dict, os.path.join(self.commit_path, "dict.pkl"))
+        save_pkl(code_msg_dict, paths["dict"])
         save_pkl(
             [self.ids, self.messages, self.cc2vec_codes, self.labels],
-            os.path.join(self.commit_path, "cc2vec.pkl"),
+            paths["cc2vec"],
         )
         save_pkl(
             [self.ids, self.messages, self.deepjit_codes, self.labels],
-            os.path.join(self.commit_path, "deepjit.pkl"),
+            paths["deepjit"],
         )
         save_pkl(
             [self.ids, self.messages, self.simcom_codes, self.labels],
-            os.path.join(self.commit_path, "simcom.pkl"),
+            paths["simcom"],
+        )
+
+    def load_dataset(self):
+        """
+        Load the dataset saved by `to_dataset`, e.g. to split it again
+        """
+        paths = self.get_dataset_paths()
+        self.df = pd.read_csv(paths["features"], float_precision="round_trip")
+        self.code_dict = load_pkl(paths["dict"])
+        self.ids, self.messages, self.cc2vec_codes, self.labels = load_pkl(
+            paths["cc2vec"]
         )
+        self.deepjit_codes = load_pkl(paths["deepjit"])[2]
+        self.simcom_codes = load_pkl(paths["simcom"])[2]
@@ -1,4 +1,16 @@
-from utils import load_json, load_pkl, save_json, save_pkl
+from utils import (
+    PICKLE_PROTOCOL,
+    atomic_write,
+    get_pkl_size,
+    load_json,
+    load_pkl,
+    save_json,
+    save_pkl,
+)
+from .State import FeatureState
+from .Store import CommitStore
+import pickle
+import json
 import os
 
 
@@ -23,9 +35,15 @@ class Repository:
         |   |   --extracted_info.json
         |   |   --commit_ids.pkl
         |   |   --repo_commits_<num>.pkl
+        |   |   --repo_commits_<num>.journal
+        |   |   --repo_shards.json
         |   |   --repo_features.csv
+        |   |   --repo_state.pkl
         |   |   --repo_bug_fix.json
+        |   |   --repo_bug_fix.jsonl
         |   |   --bszz.yml
+        |   |   --bszz_output.json
+        |   |   --stage_cache.json
         """
         self.owner = repo_owner
         self.name = repo_name
@@ -40,25 +58,134 @@ class Repository:
             ),
             "ids": os.path.join(self.save_path, self.owner, self.name, "commit_ids.pkl"),
             "commits": os.path.join(self.save_path, self.owner, self.name, "repo_commits_{}.pkl"),
+            "commits_journal": os.path.join(self.save_path, self.owner, self.name, "repo_commits_{}.journal"),
+            "shards": os.path.join(self.save_path, self.owner, self.name, "repo_shards.json"),
             "features": os.path.join(self.save_path, self.owner, self.name, "repo_features.pkl"),
+            "state": os.path.join(self.save_path, self.owner, self.name, "repo_state.pkl"),
+            "patch_ids": os.path.join(self.save_path, self.owner, self.name, "repo_patch_ids.pkl"),
             "bug_fix": os.path.join(self.save_path, self.owner, self.name, "repo_bug_fix.json"),
+            "bug_fix_index": os.path.join(self.save_path, self.owner, self.name, "repo_bug_fix.jsonl"),
             "pyszz_conf": os.path.join(self.save_path, self.owner, self.name, "{}.yml"),
+            "szz_output": os.path.join(self.save_path, self.owner, self.name, "{}_output.json"),
+            "stage_cache": os.path.join(self.save_path, self.owner, self.name, "stage_cache.json"),
         }
         self.ids = {}
         self.commits = {}
         self.features = {}
+        self.state = FeatureState()
         self.uncommit = {}
+        self.bug_fix_ids = None
+        self.patch_ids = {}
+        self.commit_store = None
+        self.store_options_key = None
+        self.shards = None
 
     # load
     def load_ids(self):
         self.ids = load_pkl(self.paths["ids"])
 
+    def load_patch_ids(self):
+        self.patch_ids = load_pkl(self.paths["patch_ids"])
+
     def load_commits(self, num):
-        self.commits = load_pkl(self.paths["commits"].format(num))
+        self.commits = self.read_commits(num)
+
+    def read_commits(self, num):
+        """
+        Read a commits file with the commits appended to its journal, resolving
+        the commits kept in the commit store
+        """
+        commits = load_pkl(self.paths["commits"].format(num))
+        commits.update(self.read_journal(num))
+        for commit_id, commit in commits.items():
+            if "store_key" in commit:
+                record = self.get_commit_store().get(commit["store_key"])
+                assert record is not None, "Commit store: missing {}".format(
+                    commit["store_key"]
+                )
+                commits[commit_id] = record
+        return commits
+
+    def load_shards(self):
+        """
+        Load the shard manifest: for each commits file saved since the manifest
+        exists, its number of commits, the serialized size of its commits
+        (before compression, i.e. roughly the memory taken by `load_commits`,
+        None if unknown),
+        its size on disk and its first and last commit ids.
+        """
+        self.shards = load_json(self.paths["shards"]).get("shards", {})
+        return self.shards
+
+    def read_journal(self, num):
+        """
+        Read the commits appended to the journal of a commits file since it was
+        last saved. The last record of a killed run may be partially written:
+        it is dropped, so that the next records are appended after the
+        complete ones.
+        """
+        path = self.paths["commits_journal"].format(num)
+        commits = {}
+        if not os.path.exists(path):
+            return commits
+        with open(path, "r+b") as f:
+            end = 0
+            while True:
+                try:
+                    commits.update(pickle.load(f))
+                except EOFError:
+                    break
+                except Exception:
+                    f.truncate(end)
+                    break
+                end = f.tell()
+        return commits
 
     def load_features(self):
         self.features = load_pkl(self.paths["features"])
 
+    def load_state(self):
+        """
+        Load the per-file and per-author state left by the last feature extraction
+        """
+        state = load_pkl(self.paths["state"])
+        # states saved before interning are replayed again
+        if not isinstance(state, FeatureState):
+            return False
+        self.state = state
+        return True
+
+    def load_bug_fix(self):
+        """
+        Load the set of bug fix ids from the JSON Lines index,
+        creating it from the JSON file of an older extraction if needed
+        """
+        self.bug_fix_ids = set()
+        if not os.path.exists(self.paths["bug_fix_index"]):
+            bug_fix = load_json(self.paths["bug_fix"])
+            if bug_fix:
+                self.append_bug_fix([fix["fix_commit_hash"] for fix in bug_fix])
+            return self.bug_fix_ids
+        records = self.read_bug_fix_index()
+        self.bug_fix_ids.update(record["fix_commit_hash"] for record in records)
+        return self.bug_fix_ids
+
+    def read_bug_fix_index(self):
+        records = []
+        truncated = False
+        with open(self.paths["bug_fix_index"], "r") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # the last line of a killed run may be partially written
+                    truncated = True
+        if truncated:
+            with atomic_write(self.paths["bug_fix_index"], "w") as f:
+                for record in records:
+                    f.write(json.dumps(record) + "\n")
+        return records
+
     def get_last_config(self):
         config = load_json(self.paths["extracted_info"])
         if config:
@@ -73,12 +200,18 @@ class Repository:
     def get_commits_path(self, num):
         return self.paths["commits"].format(num)
 
+    def get_journal_path(self, num):
+        return self.paths["commits_journal"].format(num)
+
     def get_repo_path(self):
         return self.repo_path
     
     def get_pyszz_conf_path(self, conf):
         return self.paths["pyszz_conf"].format(conf)
 
+    def get_szz_output_path(self, conf):
+        return self.paths["szz_output"].format(conf)
+
     def get_path(self):
         return os.path.join(self.repo_path, self.owner, self.name)
 
@@ -95,24 +228,134 @@ class Repository:
     def save_ids(self):
         save_pkl(self.ids, self.paths["ids"])
 
+    def save_patch_ids(self):
+        save_pkl(self.patch_ids, self.paths["patch_ids"])
+
     def save_commits(self, num):
-        save_pkl(self.commits, self.paths["commits"].format(num))
+        """
+        Save a commits file, replacing its journal, and get the pickled size of
+        its commits, or None with a commit store: the file then only
+        references the store's records.
+        """
+        commits = self.store_commits(self.commits)
+        num_bytes = save_pkl(commits, self.paths["commits"].format(num))
+        if os.path.exists(self.paths["commits_journal"].format(num)):
+            os.remove(self.paths["commits_journal"].format(num))
+        return num_bytes if self.commit_store is None else None
+
+    def append_commits(self, num, commits):
+        """
+        Append `commits` to the journal of the commits file `num`, so that a
+        checkpoint does not save the whole file again
+        """
+        commits = self.store_commits(commits)
+        with open(self.paths["commits_journal"].format(num), "ab") as f:
+            pickle.dump(commits, f, protocol=PICKLE_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def get_journal_size(self, num):
+        path = self.get_journal_path(num)
+        return os.path.getsize(path) if os.path.exists(path) else 0
+
+    def store_commits(self, commits):
+        """
+        With a commit store, put `commits` into the store, referenced before
+        being written, and get the references to save instead
+        """
+        if self.commit_store is None:
+            return commits
+        keys = {
+            commit_id: self.commit_store.get_key(commit_id, self.store_options_key)
+            for commit_id in commits
+        }
+        self.commit_store.add_refs(self.get_store_repo_key(), keys.values())
+        for commit_id, commit in commits.items():
+            self.commit_store.put(commit, keys[commit_id])
+        return {
+            commit_id: {"commit_id": commit_id, "store_key": key}
+            for commit_id, key in keys.items()
+        }
+
+    def get_commits_size(self, commits=None):
+        commits = self.commits if commits is None else commits
+        return sum(get_pkl_size(commit) for commit in commits.values())
+
+    def save_shard(self, num, num_bytes):
+        """
+        Record the commits file `num`, holding the current commits whose
+        serialized size is `num_bytes` (None if unknown), into the shard
+        manifest
+        """
+        if self.shards is None:
+            self.load_shards()
+        commit_ids = list(self.commits)
+        self.shards[str(num)] = {
+            "num_commits": len(commit_ids),
+            "num_bytes": num_bytes,
+            "file_size": os.path.getsize(self.paths["commits"].format(num)),
+            "first_commit": commit_ids[0] if commit_ids else None,
+            "last_commit": commit_ids[-1] if commit_ids else None,
+        }
+        save_json({"shards": self.shards}, self.paths["shards"])
+
+    def set_commit_store(self, commit_store, options_key):
+        self.commit_store = commit_store
+        self.store_options_key = options_key
+
+    def get_commit_store(self):
+        """
+        Get the commit store, or open the one the repository was extracted with
+        """
+        if self.commit_store is None:
+            path = self.get_last_config().get("commit_store")
+            assert path, "No commit store for {}/{}".format(self.owner, self.name)
+            self.commit_store = CommitStore(path)
+        return self.commit_store
+
+    def get_store_repo_key(self):
+        return os.path.abspath(os.path.join(self.save_path, self.owner, self.name))
 
     def save_bug_fix(self, ids):
-        bug_fix = load_json(self.paths["bug_fix"])
-        if not bug_fix:
-            bug_fix = []
-        existed_ids = map(lambda x: x["fix_commit_hash"], bug_fix)
+        """
+        Append the new bug fix ids to the JSON Lines index
+        """
+        if self.bug_fix_ids is None:
+            self.load_bug_fix()
+        new_ids = []
         for id in ids:
-            if id not in existed_ids:
-                bug_fix.append(
-                    {"fix_commit_hash": id, "repo_name": os.path.join(self.owner, self.name)}
-                )
-        save_json(bug_fix, self.paths["bug_fix"])
+            if id not in self.bug_fix_ids:
+                self.bug_fix_ids.add(id)
+                new_ids.append(id)
+        if new_ids:
+            self.append_bug_fix(new_ids)
+
+    def append_bug_fix(self, ids):
+        with open(self.paths["bug_fix_index"], "a") as f:
+            for id in ids:
+                f.write(json.dumps(self.get_bug_fix_record(id)) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.bug_fix_ids.update(ids)
+
+    def get_bug_fix_record(self, id):
+        return {"fix_commit_hash": id, "repo_name": os.path.join(self.owner, self.name)}
+
+    def export_bug_fix(self):
+        """
+        Write the bug fix list as the JSON file PySZZ expects
+        """
+        if os.path.exists(self.paths["bug_fix_index"]):
+            save_json(self.read_bug_fix_index(), self.paths["bug_fix"])
+        elif not os.path.exists(self.paths["bug_fix"]):
+            save_json([], self.paths["bug_fix"])
 
     def save_features(self):
         save_pkl(self.features, self.paths["features"])
 
+    def save_state(self):
+        save_pkl(self.state, self.paths["state"])
+
     def save_config(self, config):
         cfg = {
             "owner": self.owner,
@@ -6,16 +6,48 @@ import numpy as np
 import os
 
 
+PARTS = ["part_1_part_4", "part_3_part_4", "part_4"]
+
+
 class Splitter:
-    def __init__(self, save_path: str):
+    def __init__(
+        self,
+        save_path: str,
+        parts: list = None,
+        val_train_ratio: float = 5 / 75,
+        seed: int = None,
+    ):
+        """
+        Split the processed data into the training `parts`, by default all
+        of them, each with a random validation set of `val_train_ratio` of
+        its size, and a common test part. A `seed` makes the validation sets
+        reproducible.
+        """
+        parts = parts or PARTS
+        for part in parts:
+            assert part in PARTS, "Invalid part: {}".format(part)
         self.path = os.path.abspath(save_path)
+        self.parts = parts
+        self.val_train_ratio = val_train_ratio
+        self.seed = seed
+        self.outputs = []
 
     def set_processor(self, processor: Processor):
         self.processor = processor
 
+    def get_config(self):
+        return {
+            "parts": self.parts,
+            "val_train_ratio": self.val_train_ratio,
+            "seed": self.seed,
+        }
+
     def run(self):
-        parts = ["part_1_part_4", "part_3_part_4", "part_4"]
-        for part in parts:
+        self.random = (
+            np.random if self.seed is None else np.random.RandomState(self.seed)
+        )
+        self.outputs = []
+        for part in self.parts:
             self.split_data(part)
 
     def split_train_test_indexes(self, size, part="part_1_part_4"):
@@ -51,7 +83,7 @@ class Splitter:
         }
 
     def split_train_val_indexes(self, indexes, val_train_ratio=5 / 75):
-        val_indexes = np.random.choice(
+        val_indexes = self.random.choice(
             indexes["train"],
             int(len(indexes["train"]) * val_train_ratio),
             replace=False,
@@ -75,12 +107,11 @@ class Splitter:
         for key in indexes:
             splitted_df = self.processor.df.iloc[indexes[key]]
             save_part = part if key == "train" else "part_5"
-            splitted_df.to_csv(
-                os.path.join(self.processor.feature_path, f"{name}_{save_part}.csv"),
-                index=False,
-            )
+            path = os.path.join(self.processor.feature_path, f"{name}_{save_part}.csv")
+            splitted_df.to_csv(path, index=False)
+            self.outputs.append(path)
             del splitted_df
-        indexes = self.split_train_val_indexes(indexes)
+        indexes = self.split_train_val_indexes(indexes, self.val_train_ratio)
         # split cc2vec and deepjit codes
         for key in indexes:
             save_part = f"{name}_{part}_{key}" if key != "test" else f"{name}_part_5"
@@ -92,19 +123,18 @@ class Splitter:
             labels = self.get_values(self.processor.labels, indexes[key])
             if key == "train":
                 train_dict = create_dict(messages, deepjit_codes)
-                save_pkl(
-                    train_dict,
-                    os.path.join(self.processor.commit_path, f"{save_part}_dict.pkl"),
-                )
-            save_pkl(
-                [ids, messages, cc2vec_codes, labels],
-                os.path.join(self.processor.commit_path, f"cc2vec_{save_part}.pkl"),
+                self.save_output(train_dict, f"{save_part}_dict.pkl")
+            self.save_output(
+                [ids, messages, cc2vec_codes, labels], f"cc2vec_{save_part}.pkl"
             )
-            save_pkl(
-                [ids, messages, deepjit_codes, labels],
-                os.path.join(self.processor.commit_path, f"deepjit_{save_part}.pkl"),
+            self.save_output(
+                [ids, messages, deepjit_codes, labels], f"deepjit_{save_part}.pkl"
             )
-            save_pkl(
-                [ids, messages, simcom_codes, labels],
-                os.path.join(self.processor.commit_path, f"simcom_{save_part}.pkl"),
-            )
\ No newline at end of file
+            self.save_output(
+                [ids, messages, simcom_codes, labels], f"simcom_{save_part}.pkl"
+            )
+
+    def save_output(self, data, file):
+        path = os.path.join(self.processor.commit_path, file)
+        save_pkl(data, path)
+        self.outputs.append(path)
@@ -0,0 +1,56 @@
+from utils import get_subs_dire_name
+from array import array
+
+
+class FeatureState:
+    def __init__(self):
+        """
+        The per-file and per-author state replayed by feature extraction.
+        Paths and authors are interned to integer ids: each file keeps the set
+        of its authors' ids and typed arrays hold its number of changes and
+        last change time, while each author maps path ids to a typed array of
+        change times.
+        """
+        self.path_ids = {}
+        self.paths = []
+        self.path_subsystems = []
+        self.author_ids = {}
+        self.authors = []
+        self.file_authors = []
+        self.file_nuc = array("l")
+        self.file_time = array("q")
+        self.author_exp = []
+
+    def get_path_id(self, path):
+        path_id = self.path_ids.get(path)
+        if path_id is None:
+            path_id = len(self.paths)
+            self.path_ids[path] = path_id
+            self.paths.append(path)
+            self.path_subsystems.append(get_subs_dire_name(path)[0])
+            self.file_authors.append(set())
+            self.file_nuc.append(0)
+            self.file_time.append(0)
+        return path_id
+
+    def get_author_id(self, author):
+        author_id = self.author_ids.get(author)
+        if author_id is None:
+            author_id = len(self.authors)
+            self.author_ids[author] = author_id
+            self.authors.append(author)
+            self.author_exp.append({})
+        return author_id
+
+    def get_author_sexp(self, author_exp, subsystems):
+        """
+        Count the files changed by an author in `subsystems`
+        """
+        sexp = 0
+        for path_id in author_exp:
+            if self.path_subsystems[path_id] in subsystems:
+                sexp += 1
+        return sexp
+
+    def get_file_author_names(self, path_id):
+        return set(self.authors[author_id] for author_id in self.file_authors[path_id])
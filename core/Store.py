@@ -0,0 +1,118 @@
+from utils import load_pkl, save_pkl
+from contextlib import closing
+import hashlib
+import sqlite3
+import json
+import time
+import os
+
+
+class CommitStore:
+    def __init__(self, path: str):
+        """
+        A content-addressed store of extracted commits shared by repositories,
+        e.g. forks and mirrors of one project. A record is keyed by the commit
+        id and the extraction options changing its content, and is kept as
+        long as a repository's commits files reference it.
+
+        Folder's structure:
+        --path
+        |   --store.db // the references of each repository to the records
+        |   --objects
+        |   |   --{commit_id[:2]}
+        |   |   |   --{commit_id}_{options_key}.pkl
+        """
+        self.path = os.path.abspath(path)
+        if not os.path.exists(os.path.join(self.path, "objects")):
+            os.makedirs(os.path.join(self.path, "objects"))
+        with self.connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS refs ("
+                "repo TEXT NOT NULL, key TEXT NOT NULL, PRIMARY KEY (repo, key))"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS refs_key ON refs (key)")
+
+    def connect(self):
+        """
+        A new connection for each operation, as the store is shared by threads
+        and processes
+        """
+        return closing(sqlite3.connect(os.path.join(self.path, "store.db"), timeout=60))
+
+    @staticmethod
+    def get_options_key(options: dict):
+        options = json.dumps(options, sort_keys=True)
+        return hashlib.sha1(options.encode()).hexdigest()[:12]
+
+    def get_key(self, commit_id, options_key):
+        return "{}_{}".format(commit_id, options_key)
+
+    def get_record_path(self, key):
+        return os.path.join(self.path, "objects", key[:2], key + ".pkl")
+
+    def contains(self, commit_id, options_key):
+        key = self.get_key(commit_id, options_key)
+        return os.path.exists(self.get_record_path(key))
+
+    def get(self, key):
+        """
+        Get a stored commit, or None
+        """
+        path = self.get_record_path(key)
+        if not os.path.exists(path):
+            return None
+        return load_pkl(path)
+
+    def put(self, commit, key):
+        """
+        Store a commit if it is not stored yet. A stored record is touched, so
+        that a concurrent `gc` does not remove it before it is referenced.
+        """
+        path = self.get_record_path(key)
+        if os.path.exists(path):
+            os.utime(path)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        save_pkl(commit, path)
+
+    def add_refs(self, repo_key, keys):
+        with self.connect() as db, db:
+            db.executemany(
+                "INSERT OR IGNORE INTO refs (repo, key) VALUES (?, ?)",
+                [(repo_key, key) for key in keys],
+            )
+
+    def get_refcount(self, key):
+        with self.connect() as db:
+            query = "SELECT COUNT(*) FROM refs WHERE key = ?"
+            return db.execute(query, (key,)).fetchone()[0]
+
+    def remove_repo(self, repo_key):
+        """
+        Drop all the references of a deleted repository
+        """
+        with self.connect() as db, db:
+            db.execute("DELETE FROM refs WHERE repo = ?", (repo_key,))
+
+    def gc(self, min_age: float = 3600):
+        """
+        Delete the records no repository references and get their number.
+        Records written or touched less than `min_age` seconds ago are kept,
+        as a running extraction may be about to reference them.
+        """
+        with self.connect() as db:
+            keys = set(key for (key,) in db.execute("SELECT DISTINCT key FROM refs"))
+        num_removed = 0
+        now = time.time()
+        objects_path = os.path.join(self.path, "objects")
+        for folder in os.listdir(objects_path):
+            for file in os.listdir(os.path.join(objects_path, folder)):
+                path = os.path.join(objects_path, folder, file)
+                if not file.endswith(".pkl") or file[:-4] in keys:
+                    continue
+                if now - os.path.getmtime(path) < min_age:
+                    continue
+                os.remove(path)
+                num_removed += 1
+        return num_removed
@@ -1,6 +1,40 @@
-from .Extractor import Extractor
-from .Processor import Processor
-from .Labeler import PySZZ
-from .Splitter import Splitter
-from .Repository import Repository
-from .Dict import Dict
\ No newline at end of file
+import importlib
+import types
+import sys
+
+# The classes are imported on first use, so that a stage only imports the
+# modules it needs, e.g. extracting commits does not import pandas
+EXPORTS = {
+    "Extractor": "Extractor",
+    "Processor": "Processor",
+    "PySZZ": "Labeler",
+    "BSZZ": "Labeler",
+    "Splitter": "Splitter",
+    "Repository": "Repository",
+    "Dict": "Dict",
+    "ScoringDaemon": "Daemon",
+    "CommitStore": "Store",
+    "StageCache": "Cache",
+    "CrawlCoordinator": "Coordinator",
+}
+__all__ = list(EXPORTS)
+
+
+class CoreModule(types.ModuleType):
+    def __setattr__(self, name, value):
+        # importing a submodule, e.g. by `from core.Extractor import ...`,
+        # binds its name to the module: keep the class exported by that name
+        if isinstance(value, types.ModuleType) and EXPORTS.get(name) == name:
+            value = getattr(value, name)
+        super().__setattr__(name, value)
+
+
+sys.modules[__name__].__class__ = CoreModule
+
+
+def __getattr__(name):
+    if name not in EXPORTS:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    module = importlib.import_module("." + EXPORTS[name], __name__)
+    globals()[name] = getattr(module, name)
+    return globals()[name]
@@ -0,0 +1,40 @@
+from argparse import ArgumentParser
+from core import Extractor, Repository, ScoringDaemon
+from main import add_common_params
+
+
+def get_params():
+    parser = ArgumentParser()
+    parser.add_argument("--repo_name", type=str, required=True)
+    parser.add_argument("--repo_owner", type=str, required=True)
+    parser.add_argument("--daemon_host", type=str, default="127.0.0.1")
+    parser.add_argument("--daemon_port", type=int, default=8765)
+    parser.add_argument("--daemon_socket", type=str, default=None)
+    add_common_params(parser)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    config = get_params()
+    repo_path = config.repo_path if config.mode == "local" else config.repo_clone_path
+    repo = Repository(
+        config.repo_owner,
+        config.repo_name,
+        config.repo_save_path,
+        repo_path,
+        config.repo_language,
+    )
+    extractor = Extractor(
+        start=config.extractor_start,
+        end=config.extractor_end,
+        language=config.repo_language,
+        save=False,
+        num_git_workers=config.extractor_num_git_workers,
+        include=config.extractor_include,
+        exclude=config.extractor_exclude,
+        blame=not config.extractor_no_blame,
+        command_timeout=config.extractor_command_timeout,
+    )
+    daemon = ScoringDaemon(extractor, repo)
+    daemon.load()
+    daemon.serve(config.daemon_host, config.daemon_port, config.daemon_socket)
@@ -0,0 +1,74 @@
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import ProcessPoolExecutor
+from main import add_common_params, create_default_save_folders
+from Pipeline import BasicPipeline
+from core import CrawlCoordinator
+
+COMMANDS = {
+    "plan": "list the commits to extract and queue them in ranges",
+    "work": "extract the queued ranges until none is left",
+    "merge": "store the extracted ranges and compute the features",
+}
+
+
+def get_params():
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for command, description in COMMANDS.items():
+        subparser = subparsers.add_parser(command, help=description)
+        subparser.add_argument("--repo_name", type=str, required=True)
+        subparser.add_argument("--repo_owner", type=str, required=True)
+        subparser.add_argument("--distributed_path", type=str, required=True)
+        subparser.add_argument("--distributed_range_size", type=int, default=500)
+        subparser.add_argument("--distributed_lease_time", type=float, default=3600)
+        subparser.add_argument("--distributed_num_workers", type=int, default=1)
+        subparser.add_argument("--distributed_worker_id", type=str, default=None)
+        add_common_params(subparser)
+    return parser.parse_args()
+
+
+def get_coordinator(cfg):
+    crawler = BasicPipeline(cfg, stages=["extract"])
+    crawler.set_repo(cfg)
+    coordinator = CrawlCoordinator(
+        crawler.extractor,
+        cfg.distributed_path,
+        range_size=cfg.distributed_range_size,
+        lease_time=cfg.distributed_lease_time,
+    )
+    coordinator.set_repo(crawler.repo)
+    return coordinator
+
+
+def run_worker(cfg, num):
+    worker_id = cfg.distributed_worker_id
+    if worker_id and cfg.distributed_num_workers > 1:
+        worker_id = "{}-{}".format(worker_id, num)
+    return get_coordinator(cfg).work(worker_id)
+
+
+if __name__ == "__main__":
+    config = get_params()
+    create_default_save_folders()
+    if config.command != "plan":
+        # only the plan may start the extraction from scratch
+        config.extractor_force_reextract = False
+    if config.command == "plan":
+        get_coordinator(config).plan()
+    elif config.command == "work" and config.distributed_num_workers > 1:
+        # the repository is cloned once, then shared by the local workers
+        coordinator = get_coordinator(config)
+        worker_config = Namespace(**vars(config))
+        worker_config.mode = "local"
+        worker_config.repo_path = coordinator.repo.repo_path
+        with ProcessPoolExecutor(max_workers=config.distributed_num_workers) as pool:
+            futures = [
+                pool.submit(run_worker, worker_config, num)
+                for num in range(config.distributed_num_workers)
+            ]
+            num_ranges = sum(future.result() for future in futures)
+        print("Extracted ranges: {}".format(num_ranges))
+    elif config.command == "work":
+        print("Extracted ranges: {}".format(run_worker(config, 0)))
+    else:
+        get_coordinator(config).merge()
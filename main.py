@@ -1,40 +1,104 @@
 from argparse import ArgumentParser
-from Pipeline import BasicPipeline
 from utils import is_supported_language
+import sys
 import os
 
+COMMANDS = {
+    "extract": "extract the new commits, without their features",
+    "features": "compute the features of the extracted commits",
+    "label": "label the bug inducing commits of the extracted fixes",
+    "process": "process the labeled data into the dataset",
+    "split": "split the processed dataset",
+    "run": "run all the stages (default)",
+}
 
-def get_params():
-    parser = ArgumentParser()
+
+def parse_languages(x):
+    return [i for i in x.split(" ") if is_supported_language(i)] if x else []
+
+
+def parse_globs(x):
+    return x.split(" ") if x else []
+
+
+def add_common_params(parser):
+    """
+    Add the options shared by every repository of a run
+    """
     valid_modes = ["local", "remote"]
     parser.add_argument("--mode", type=str, default="local", choices=valid_modes)
     parser.add_argument("--repo_path", type=str, default="repo")
-    parser.add_argument("--repo_name", type=str, required=True)
-    parser.add_argument("--repo_owner", type=str, required=True)
-    parser.add_argument(
-        "--repo_language",
-        type=lambda x: (
-            [i for i in x.split(" ") if is_supported_language(i)] if x else []
-        ),
-        default="",
-    )
+    parser.add_argument("--repo_language", type=parse_languages, default="")
     parser.add_argument("--repo_save_path", type=str, default="save")
     parser.add_argument("--repo_clone_path", type=str, default="repo")
     parser.add_argument("--repo_clone_url", type=str)
+    parser.add_argument("--repo_clone_bare", action="store_true")
+    parser.add_argument("--repo_clone_filter", type=str, default=None)
+    parser.add_argument("--repo_clone_refs", type=parse_globs, default="")
+    parser.add_argument("--repo_object_cache", type=str, default=None)
     parser.add_argument("--extractor_start", type=str, default=None)
     parser.add_argument("--extractor_end", type=str, default=None)
     parser.add_argument("--extractor_num_commits_per_file", type=int, default=5000)
+    parser.add_argument("--extractor_max_shard_bytes", type=int, default=0)
     parser.add_argument("--extractor_save", action="store_true")
     parser.add_argument("--extractor_force_reextract", action="store_true")
     parser.add_argument("--extractor_check_uncommit", action="store_true")
+    parser.add_argument("--extractor_num_git_workers", type=int, default=8)
+    parser.add_argument("--extractor_checkpoint_interval", type=int, default=60)
+    parser.add_argument("--extractor_include", type=parse_globs, default="")
+    parser.add_argument("--extractor_exclude", type=parse_globs, default="")
+    parser.add_argument("--extractor_no_blame", action="store_true")
+    parser.add_argument("--extractor_max_files", type=int, default=0)
+    parser.add_argument("--extractor_max_changed_lines", type=int, default=0)
+    parser.add_argument("--extractor_max_file_size", type=int, default=0)
+    parser.add_argument(
+        "--extractor_oversized", type=str, default="skip", choices=["skip", "truncate"]
+    )
+    parser.add_argument("--extractor_command_timeout", type=float, default=None)
+    parser.add_argument(
+        "--extractor_feature_engine", type=str, default="loop", choices=["loop", "bulk"]
+    )
+    parser.add_argument("--extractor_validate_features", action="store_true")
+    parser.add_argument("--extractor_dedup_patches", action="store_true")
+    parser.add_argument("--extractor_commit_store", type=str, default=None)
+    parser.add_argument(
+        "--labeler", type=str, default="pyszz", choices=["pyszz", "bszz"]
+    )
     parser.add_argument("--pyszz_path", type=str, default="pyszz_v2")
     parser.add_argument("--pyszz_keep_output", type=int, default=50)
     parser.add_argument("--pyszz_conf", type=str, default="bszz")
     parser.add_argument("--pyszz_log_path", type=str, default="log")
+    parser.add_argument(
+        "--save_compression", type=str, default="none", choices=["none", "zstd", "lz4"]
+    )
+    parser.add_argument("--save_compression_level", type=int, default=None)
+    parser.add_argument("--pipeline_overlap", action="store_true")
+    parser.add_argument("--pipeline_queue_size", type=int, default=1000)
+    parser.add_argument("--pipeline_no_cache", action="store_true")
     parser.add_argument("--processor_save", action="store_true")
+    parser.add_argument("--processor_line_cache_size", type=int, default=1 << 18)
     parser.add_argument("--dataset_save_path", type=str, default="dataset")
+    parser.add_argument("--splitter_parts", type=parse_globs, default="")
+    parser.add_argument("--splitter_val_ratio", type=float, default=5 / 75)
+    parser.add_argument("--splitter_seed", type=int, default=None)
+    return parser
+
 
-    return parser.parse_args()
+def get_params(argv=None):
+    """
+    Parse `command [options]`. Without a command, all the stages are run.
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in list(COMMANDS) + ["-h", "--help"]:
+        argv = ["run"] + argv
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    for command, description in COMMANDS.items():
+        subparser = subparsers.add_parser(command, help=description)
+        subparser.add_argument("--repo_name", type=str, required=True)
+        subparser.add_argument("--repo_owner", type=str, required=True)
+        add_common_params(subparser)
+    return parser.parse_args(argv)
 
 
 def create_default_save_folders():
@@ -47,6 +111,14 @@ def create_default_save_folders():
 if __name__ == "__main__":
     config = get_params()
     create_default_save_folders()
-    crawler = BasicPipeline(config)
-    crawler.set_repo(config)
-    crawler.run()
+    # imported here, so that each command only imports the modules it needs
+    from Pipeline import BasicPipeline
+
+    if config.command == "run":
+        crawler = BasicPipeline(config)
+        crawler.set_repo(config)
+        crawler.run()
+    else:
+        crawler = BasicPipeline(config, stages=[config.command])
+        crawler.set_repo(config)
+        crawler.run_stage(config.command)
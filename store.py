@@ -0,0 +1,23 @@
+from argparse import ArgumentParser
+from core import CommitStore
+import os
+
+
+def get_params():
+    parser = ArgumentParser()
+    parser.add_argument("--commit_store", type=str, required=True)
+    parser.add_argument("--remove_repo", type=str, nargs="*", default=[])
+    parser.add_argument("--gc", action="store_true")
+    parser.add_argument("--gc_min_age", type=float, default=3600)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    config = get_params()
+    store = CommitStore(config.commit_store)
+    for repo_path in config.remove_repo:
+        # a repository is referenced by its extracted data's folder
+        store.remove_repo(os.path.abspath(repo_path))
+        print("Removed references of {}".format(repo_path))
+    if config.gc:
+        print("Removed records: {}".format(store.gc(config.gc_min_age)))
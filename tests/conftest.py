@@ -0,0 +1,110 @@
+import subprocess
+import pytest
+import sys
+import os
+
+# the modules import each other from the repository's root, e.g. `from utils import ...`
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core import Repository
+
+DAY = 24 * 3600
+START_DATE = 1600000000
+
+# (author, message, {path: content, or None to delete it})
+HISTORY = [
+    ("alice", "init", {"src/app.py": "a = 1\nb = 2\nc = 3\n", "README": "doc\n"}),
+    ("bob", "add util", {"src/util.py": "def f():\n    return 1\n"}),
+    ("alice", "edit app", {"src/app.py": "a = 1\nb = 20\nc = 3\nd = 4\n"}),
+    (
+        "carol",
+        "add java",
+        {
+            "lib/Main.java": "class Main {\n}\n",
+            "src/util.py": "def f():\n    return 2\n",
+        },
+    ),
+    ("bob", "fix bug in app", {"src/app.py": "a = 1\nb = 2\nc = 3\nd = 4\n"}),
+    (
+        "alice",
+        "refactor",
+        {
+            "lib/Main.java": "class Main {\n    int x;\n}\n",
+            "src/app.py": "a = 1\nc = 3\nd = 4\n",
+        },
+    ),
+    ("carol", "remove util", {"src/util.py": None, "src/app.py": "a = 10\nc = 3\n"}),
+    ("bob", "fix crash", {"lib/Main.java": "class Main {\n    int y;\n}\n"}),
+]
+
+
+def git(args, cwd, date=None, author="alice"):
+    """
+    Run a git command as `author`, at the timestamp `date`, and get its output
+    """
+    env = dict(
+        os.environ,
+        GIT_AUTHOR_NAME=author,
+        GIT_AUTHOR_EMAIL="{}@example.com".format(author),
+        GIT_COMMITTER_NAME=author,
+        GIT_COMMITTER_EMAIL="{}@example.com".format(author),
+    )
+    if date is not None:
+        env["GIT_AUTHOR_DATE"] = env["GIT_COMMITTER_DATE"] = "{} +0000".format(date)
+    result = subprocess.run(
+        ["git"] + args, cwd=cwd, env=env, check=True, capture_output=True
+    )
+    return result.stdout.decode()
+
+
+def write_files(path, files):
+    for file, content in files.items():
+        file_path = os.path.join(path, file)
+        if content is None:
+            os.remove(file_path)
+            continue
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "w") as f:
+            f.write(content)
+
+
+def commit_files(path, author, message, files, date):
+    write_files(path, files)
+    git(["add", "-A"], path)
+    git(["commit", "-q", "-m", message], path, date, author)
+    return git(["rev-parse", "HEAD"], path).strip()
+
+
+def create_repo(path, history=HISTORY, date=START_DATE):
+    """
+    Create a repository at `path` committing `history`, a commit every 3 days
+    """
+    os.makedirs(path)
+    git(["init", "-q", "-b", "main"], path)
+    for author, message, files in history:
+        commit_files(path, author, message, files, date)
+        date += 3 * DAY
+    return path
+
+
+@pytest.fixture
+def repo_path(tmp_path):
+    """
+    The folder of cloned repositories, holding `owner/name` committing `HISTORY`
+    """
+    create_repo(str(tmp_path / "repo" / "owner" / "name"))
+    return str(tmp_path / "repo")
+
+
+@pytest.fixture
+def new_repo(tmp_path, repo_path):
+    """
+    Get a new `Repository` for `owner/name`, saved into `tmp_path/save_name`
+    """
+
+    def new_repo(save_name="save", language=["Python", "Java"]):
+        return Repository(
+            "owner", "name", str(tmp_path / save_name), repo_path, language
+        )
+
+    return new_repo
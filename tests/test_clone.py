@@ -0,0 +1,65 @@
+from core import Extractor, Repository
+from utils import clone_repo, exec_cmd
+from conftest import git
+import pytest
+import os
+
+CLONE_MODES = {
+    "bare": {"bare": True},
+    "filter": {"blob_filter": "blob:none"},
+    "bare_filter": {"bare": True, "blob_filter": "blob:none"},
+    "object_cache": {"object_cache": "cache"},
+    "bare_object_cache": {"bare": True, "object_cache": "cache"},
+}
+
+
+def extract_clone(tmp_path, url, mode, **options):
+    """
+    Clone `url` into `tmp_path/clone_{mode}` and extract it. Get the repository
+    with its ids, commits and features loaded.
+    """
+    clone_path = str(tmp_path / "clone_{}".format(mode))
+    if "object_cache" in options:
+        options["object_cache"] = str(tmp_path / options["object_cache"])
+    clone_repo(clone_path, "owner", "name", url, **options)
+    save_path = str(tmp_path / "save_{}".format(mode))
+    repo = Repository("owner", "name", save_path, clone_path, ["Python", "Java"])
+    extractor = Extractor(language=["Python", "Java"])
+    extractor.set_repo(repo)
+    extractor.run()
+    repo.load_ids()
+    repo.load_features()
+    repo.load_commits(0)
+    return repo
+
+
+@pytest.mark.parametrize("mode", CLONE_MODES)
+def test_clone_modes_match_plain_clone(mode, repo_path, tmp_path):
+    """
+    A bare, partial or object cache clone extracts the same commits and
+    features as a plain clone
+    """
+    path = os.path.join(repo_path, "owner", "name")
+    # let the local clones filter the blobs out
+    git(["config", "uploadpack.allowFilter", "true"], path)
+    url = "file://" + path
+    expected = extract_clone(tmp_path, url, "plain")
+    repo = extract_clone(tmp_path, url, mode, **CLONE_MODES[mode])
+    clone_path = repo.get_path()
+
+    if CLONE_MODES[mode].get("blob_filter"):
+        command = "git config --get-regexp 'remote\\..*\\.partialclonefilter'"
+        assert exec_cmd(command, cwd=clone_path) == [
+            "remote.origin.partialclonefilter blob:none"
+        ]
+    if CLONE_MODES[mode].get("object_cache"):
+        alternates = os.path.join("objects", "info", "alternates")
+        if not CLONE_MODES[mode].get("bare"):
+            alternates = os.path.join(".git", alternates)
+        assert os.path.exists(os.path.join(clone_path, alternates))
+        command = "git count-objects -v"
+        assert "count: 0" in exec_cmd(command, cwd=clone_path)
+    assert repo.ids == expected.ids
+    assert repo.features == expected.features
+    assert repo.commits == expected.commits
+    assert len(repo.features) == 6
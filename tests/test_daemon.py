@@ -0,0 +1,82 @@
+from core import Extractor, ScoringDaemon
+from core.Daemon import ScoringRequestHandler
+from http.server import ThreadingHTTPServer
+from conftest import git
+import urllib.request
+import urllib.error
+import threading
+import pytest
+import json
+import os
+
+# the features depending on the time a change is scored
+TIME_FEATURES = ["_id", "date", "age", "rexp"]
+
+
+@pytest.fixture
+def daemon_url(new_repo, repo_path, tmp_path, monkeypatch):
+    """
+    Serve a scoring daemon on the extracted repository, with no git user
+    configured, and get its url
+    """
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.setenv("GIT_CONFIG_NOSYSTEM", "1")
+    repo = new_repo()
+    extractor = Extractor(language=["Python", "Java"])
+    extractor.set_repo(repo)
+    extractor.run()
+
+    daemon = ScoringDaemon(Extractor(language=["Python", "Java"], save=False), repo)
+    daemon.load()
+    handler = type("Handler", (ScoringRequestHandler,), {"daemon": daemon})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:{}".format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+def request(url, data=None):
+    try:
+        with urllib.request.urlopen(url, data) as response:
+            return response.status, json.load(response)
+    except urllib.error.HTTPError as e:
+        return e.code, json.load(e)
+
+
+def test_score_uncommit_without_user(daemon_url, repo_path):
+    path = os.path.join(repo_path, "owner", "name")
+    with pytest.raises(Exception):
+        git(["config", "--get", "user.name"], path)
+
+    with open(os.path.join(path, "src/app.py"), "a") as f:
+        f.write("e = 5\n")
+    code, data = request(daemon_url + "/score")
+    assert code == 200
+    assert data["feature"]["la"] == 1
+    assert data["feature"]["lt"] == 2
+
+
+def test_score_patch_full_context(daemon_url, repo_path):
+    """
+    A patch with the default context scores as the same change in the working tree
+    """
+    path = os.path.join(repo_path, "owner", "name")
+    with open(os.path.join(path, "src/app.py"), "w") as f:
+        f.write("".join("l{} = {}\n".format(i, i) for i in range(20)))
+    _, uncommit = request(daemon_url + "/score")
+    patch = git(["diff"], path).encode()
+    git(["checkout", "--", "."], path)
+
+    code, data = request(daemon_url + "/score", patch)
+    assert code == 200
+    feature, expected = data["feature"], uncommit["feature"]
+    assert feature["lt"] == 2
+    for key in TIME_FEATURES:
+        feature.pop(key), expected.pop(key)
+    assert feature == expected
+
+    code, data = request(daemon_url + "/score", patch.replace(b"a = 10", b"a = 11"))
+    assert code == 400
+    assert "Cannot apply the patch" in data["error"]
@@ -0,0 +1,70 @@
+from core import Extractor, Repository
+from conftest import DAY, START_DATE, commit_files, create_repo, git
+import pytest
+
+LINES = ["l{} = {}\n".format(i, i) for i in range(1, 13)]
+CHANGED = LINES[:8] + ["l9 = 90\n"] + LINES[9:]
+
+
+@pytest.fixture
+def cherry_pick_repo(tmp_path):
+    """
+    A repository where a change of main is cherry-picked onto a branch
+    inserting lines above it, then applied again on main after a revert.
+    Get the folder of cloned repositories and the ids by name.
+    """
+    path = create_repo(
+        str(tmp_path / "repo" / "owner" / "name"),
+        [("alice", "init", {"app.py": "".join(LINES)})],
+    )
+    date = START_DATE + DAY
+    ids = {}
+    git(["checkout", "-q", "-b", "side"], path)
+    files = {"app.py": "".join(["x = 0\n", "y = 0\n"] + LINES)}
+    ids["insert"] = commit_files(path, "bob", "insert lines", files, date)
+    git(["checkout", "-q", "main"], path)
+    files = {"app.py": "".join(CHANGED)}
+    ids["change"] = commit_files(path, "alice", "change l9", files, date + DAY)
+    git(["checkout", "-q", "side"], path)
+    git(["cherry-pick", "-x", ids["change"]], path, date + 2 * DAY, "bob")
+    ids["cherry_pick"] = git(["rev-parse", "HEAD"], path).strip()
+    git(["checkout", "-q", "main"], path)
+    files = {"app.py": "".join(LINES)}
+    ids["revert"] = commit_files(path, "carol", "revert", files, date + 3 * DAY)
+    files = {"app.py": "".join(CHANGED)}
+    ids["reapply"] = commit_files(path, "carol", "reapply", files, date + 4 * DAY)
+    return str(tmp_path / "repo"), ids
+
+
+def extract(tmp_path, repo_path, save_name, dedup_patches):
+    save_path = str(tmp_path / save_name)
+    repo = Repository("owner", "name", save_path, repo_path, ["Python"])
+    extractor = Extractor(language=["Python"], dedup_patches=dedup_patches)
+    extractor.set_repo(repo)
+    extractor.run()
+    repo.load_ids()
+    repo.load_features()
+    repo.load_commits(0)
+    return repo
+
+
+def test_dedup_on_different_base(cherry_pick_repo, tmp_path):
+    """
+    A duplicate patch reuses the diff of its first commit only if it applies
+    on the same files, e.g. not for a cherry-pick onto inserted lines
+    """
+    repo_path, ids = cherry_pick_repo
+    expected = extract(tmp_path, repo_path, "save", False)
+    repo = extract(tmp_path, repo_path, "save_dedup", True)
+
+    assert repo.patch_ids
+    assert "canonical_id" not in repo.commits[ids["cherry_pick"]]
+    assert repo.commits[ids["reapply"]]["canonical_id"] == ids["change"]
+    for commit in repo.commits.values():
+        commit.pop("canonical_id", None)
+    assert repo.commits == expected.commits
+    assert repo.ids == expected.ids
+    assert repo.features == expected.features
+    # the cherry-pick is diffed with the lines inserted above the change
+    content = repo.commits[ids["cherry_pick"]]["diff"]["app.py"]["content"]
+    assert content[0]["ab"][:2] == ["x = 0", "y = 0"]
@@ -0,0 +1,82 @@
+from core import Extractor
+import subprocess
+import sqlite3
+import pytest
+import time
+import sys
+import os
+
+DISTRIBUTED = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "distributed.py"
+)
+
+
+@pytest.fixture
+def distributed(tmp_path, repo_path):
+    """
+    Get the command line of a `distributed.py` command on `owner/name`, sharing
+    `tmp_path/queue` and saving into `tmp_path/save_distributed`
+    """
+
+    def distributed(command, *args):
+        return [sys.executable, DISTRIBUTED, command] + [
+            "--repo_owner=owner",
+            "--repo_name=name",
+            "--repo_path=" + repo_path,
+            "--repo_save_path=" + str(tmp_path / "save_distributed"),
+            "--repo_language=Python Java",
+            "--distributed_path=" + str(tmp_path / "queue"),
+            "--distributed_range_size=2",
+            "--extractor_save",
+            "--pipeline_no_cache",
+        ] + list(args)
+
+    return distributed
+
+
+def test_distributed_matches_single_node(distributed, new_repo, tmp_path):
+    """
+    Extracting a repository with the ranges spread over worker processes, one
+    of them dying with a range claimed, gives the same result as a single run
+    """
+    subprocess.run(distributed("plan"), cwd=tmp_path, check=True)
+    # a worker claims the first range, then dies before its lease expires
+    with sqlite3.connect(str(tmp_path / "queue" / "queue.db")) as db:
+        db.execute(
+            "UPDATE ranges SET status = 'running', worker = 'dead', claimed = ? "
+            "WHERE num = 0",
+            (time.time() - 7200,),
+        )
+        assert db.execute("SELECT COUNT(*) FROM ranges").fetchone()[0] == 4
+
+    workers = [
+        subprocess.Popen(
+            distributed("work", "--distributed_worker_id=worker{}".format(num)),
+            cwd=tmp_path,
+        )
+        for num in range(2)
+    ]
+    assert [worker.wait() for worker in workers] == [0, 0]
+    with sqlite3.connect(str(tmp_path / "queue" / "queue.db")) as db:
+        ranges = db.execute("SELECT status, worker FROM ranges ORDER BY num")
+        ranges = ranges.fetchall()
+    assert all(status == "done" for status, _ in ranges)
+    assert ranges[0][1] in ["worker0", "worker1"]
+    subprocess.run(distributed("merge"), cwd=tmp_path, check=True)
+
+    single_repo = new_repo("save_single")
+    extractor = Extractor(language=["Python", "Java"])
+    extractor.set_repo(single_repo)
+    extractor.run()
+    single_repo.load_ids()
+    single_repo.load_features()
+
+    repo = new_repo("save_distributed")
+    repo.load_ids()
+    repo.load_features()
+    assert repo.ids == single_repo.ids
+    assert repo.features == single_repo.features
+    assert len(repo.features) == 6
+    repo.load_commits(0)
+    single_repo.load_commits(0)
+    assert repo.commits == single_repo.commits
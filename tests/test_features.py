@@ -0,0 +1,22 @@
+from core import Extractor
+from core.Features import compare_features
+
+
+def test_feature_engines_match(new_repo):
+    """
+    The bulk engine computes the same features as the replaying loop engine
+    """
+    repo = new_repo()
+    extractor = Extractor(language=["Python", "Java"], feature_engine="loop")
+    extractor.set_repo(repo)
+    extractor.run()
+    loop_features = repo.features
+    # the commits only adding files have no blamed diff
+    assert len(loop_features) == 6
+
+    extractor.feature_engine = "bulk"
+    extractor.save = False
+    extractor.extract_repo_commits_features()
+    assert list(repo.features) == list(loop_features)
+    assert compare_features(loop_features, repo.features) == []
+    assert extractor.compare_feature_engines() == []
@@ -0,0 +1,27 @@
+from core import Extractor
+from conftest import git
+import os
+
+
+def test_truncate_all_files_above_limits(new_repo, repo_path):
+    """
+    In truncate mode, a commit whose files all change more lines than the
+    limit is skipped, as in skip mode, rather than left without diff
+    """
+    repo = new_repo()
+    extractor = Extractor(
+        language=["Python", "Java"], max_changed_lines=1, oversized="truncate"
+    )
+    extractor.set_repo(repo)
+    extractor.run()
+    repo.load_ids()
+    repo.load_commits(0)
+
+    log = git(["log", "--format=%H %s"], os.path.join(repo_path, "owner", "name"))
+    ids = dict(line.split(" ", 1)[::-1] for line in log.splitlines())
+    # "refactor" changes a line of Main.java and two lines of app.py
+    refactor_id = ids.pop("refactor")
+    assert repo.ids[refactor_id] == 0
+    assert list(repo.commits[refactor_id]["diff"]) == ["lib/Main.java"]
+    assert repo.commits[refactor_id]["truncated"]
+    assert {repo.ids[commit_id] for commit_id in ids.values()} == {-4}
@@ -0,0 +1,27 @@
+from core import Extractor
+from utils.utils import PICKLE_PROTOCOL
+import pickle
+import sys
+
+
+def test_default_shards_by_count(new_repo, monkeypatch):
+    """
+    Without a byte budget, the commits are not pickled to be measured and the
+    shards only hold `num_commits_per_file` commits
+    """
+
+    def get_pkl_size(commit):
+        raise AssertionError("a commit was pickled to be measured")
+
+    monkeypatch.setattr(sys.modules["core.Extractor"], "get_pkl_size", get_pkl_size)
+    repo = new_repo()
+    extractor = Extractor(language=["Python", "Java"], num_commits_per_file=4)
+    extractor.set_repo(repo)
+    extractor.run()
+
+    shards = repo.load_shards()
+    assert [shard["num_commits"] for shard in shards.values()] == [4, 2]
+    for num, shard in shards.items():
+        repo.load_commits(int(num))
+        num_bytes = len(pickle.dumps(repo.commits, protocol=PICKLE_PROTOCOL))
+        assert shard["num_bytes"] == num_bytes
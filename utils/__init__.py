@@ -1,3 +1,4 @@
 from .aggregator import aggregator
 from .line_parser import parse_lines
-from .utils import *
\ No newline at end of file
+from .executor import AsyncExecutor, QueueWorker
+from .utils import *
@@ -0,0 +1,155 @@
+from .utils import decode_output
+import asyncio
+import threading
+import queue
+import os
+
+
+class AsyncExecutor:
+    def __init__(self, max_concurrency: int = 8, timeout: float = None):
+        """
+        Run commands as asyncio subprocesses on a background event loop.
+        At most `max_concurrency` commands run at the same time, and a command
+        running longer than `timeout` seconds is killed with a `TimeoutError`.
+
+        `submit` returns a `concurrent.futures.Future`, so callers stay
+        synchronous while independent commands run concurrently; `run` is the
+        blocking equivalent of `exec_cmd` for an argument list.
+        """
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.loop = None
+        self.thread = None
+        self.semaphore = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            # a forked child inherits the object but not the loop's thread
+            if self.loop is not None and self.pid == os.getpid():
+                return
+            self.loop = asyncio.new_event_loop()
+            # created by the first command, on the loop's thread: before
+            # Python 3.10, a semaphore is bound to the current thread's loop
+            self.semaphore = None
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+            self.thread.start()
+
+    def close(self):
+        with self.lock:
+            if self.loop is None or self.pid != os.getpid():
+                self.loop = None
+                return
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+            self.loop = None
+
+    async def exec_args(self, args: list, cwd: str = None):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self.semaphore:
+            proc = await asyncio.create_subprocess_exec(
+                *args,
+                cwd=cwd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+            try:
+                stdout, _ = await asyncio.wait_for(proc.communicate(), self.timeout)
+            except asyncio.TimeoutError:
+                try:
+                    proc.kill()
+                except ProcessLookupError:
+                    pass
+                await proc.wait()
+                raise TimeoutError(
+                    "Command timed out after {}s: {}".format(
+                        self.timeout, " ".join(args[:3])
+                    )
+                )
+        return decode_output(stdout)
+
+    def submit(self, args: list, cwd: str = None):
+        """
+        Schedule a command and return a future of its output lines
+        """
+        self.start()
+        return asyncio.run_coroutine_threadsafe(self.exec_args(args, cwd), self.loop)
+
+    def run(self, args: list, cwd: str = None):
+        """
+        Run a command and wait for its output lines
+        """
+        return self.submit(args, cwd).result()
+
+    def run_all(self, commands: list, cwd: str = None):
+        """
+        Run independent commands concurrently and return their outputs in order
+        """
+        futures = [self.submit(args, cwd) for args in commands]
+        return [future.result() for future in futures]
+
+    def __getstate__(self):
+        # the loop and its thread cannot be pickled, e.g. into a worker process
+        return {"max_concurrency": self.max_concurrency, "timeout": self.timeout}
+
+    def __setstate__(self, state):
+        self.__init__(state["max_concurrency"], state["timeout"])
+
+
+class QueueWorker:
+    STOP = object()
+
+    def __init__(self, consume, maxsize: int = 1000):
+        """
+        Run `consume` in a thread on the stream of the items `put` in a
+        bounded queue, so that a producer and its consumer overlap. The
+        producer blocks when the consumer is `maxsize` items behind.
+        `close` waits for the consumer and raises its error, if any.
+        """
+        self.consume = consume
+        self.queue = queue.Queue(maxsize)
+        self.thread = None
+        self.stopped = False
+        self.result = None
+        self.error = None
+
+    @property
+    def started(self):
+        return self.thread is not None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def iter_items(self):
+        while True:
+            item = self.queue.get()
+            if item is self.STOP:
+                self.stopped = True
+                return
+            yield item
+
+    def run(self):
+        try:
+            self.result = self.consume(self.iter_items())
+        except BaseException as e:
+            self.error = e
+        # a failed or finished consumer keeps draining, so that the producer
+        # never blocks on a full queue
+        while not self.stopped:
+            if self.queue.get() is self.STOP:
+                self.stopped = True
+
+    def put(self, item):
+        self.queue.put(item)
+
+    def close(self):
+        self.queue.put(self.STOP)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.result
@@ -1,44 +1,157 @@
+import io
 import os
 import math
 import subprocess
 import re
 import pickle
 import json
-
-
-def clone_repo(clone_path: str, owner: str, name: str, url: str):
+import itertools
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+
+PATH_CACHE_SIZE = 1 << 16
+
+
+def clone_repo(
+    clone_path: str,
+    owner: str,
+    name: str,
+    url: str,
+    bare: bool = False,
+    blob_filter: str = None,
+    object_cache: str = None,
+    refs: list = [],
+):
     """
-    Clones a repository to the current directory
+    Clones a repository into `clone_path/owner/name`, or updates it if it exists.
+    - bare: a bare repository without checkout, fetching only the branches
+    in `refs` (all branches and tags if empty)
+    - blob_filter: a partial clone filter, e.g. "blob:none", the missing
+    objects are fetched on demand
+    - object_cache: a bare repository storing the objects shared by all
+    clones, e.g. forks of the same upstream, used as their alternate
     """
     assert owner and name and url, "Invalid repository info"
-    cur_dir = os.getcwd()
-    if owner not in os.listdir(clone_path):
-        os.mkdir(os.path.join(clone_path, owner))
-    os.chdir(os.path.join(clone_path, owner))
-    if name not in os.listdir():
+    owner_path = os.path.join(clone_path, owner)
+    if not os.path.exists(owner_path):
+        os.makedirs(owner_path)
+    repo_path = os.path.join(owner_path, name)
+    if object_cache:
+        object_cache = os.path.abspath(object_cache)
+        # objects missing from a partial cache must be fetched on demand
+        cache_filter = get_partial_clone_filter(object_cache)
+        if cache_filter and cache_filter != blob_filter:
+            print(f"Using the object cache's filter {cache_filter}")
+            blob_filter = cache_filter
+    filter_option = "--filter={}".format(blob_filter) if blob_filter else ""
+    if object_cache:
+        update_object_cache(object_cache, owner, name, url, filter_option)
+
+    if name not in os.listdir(owner_path):
         print(f"Cloning ... {url}")
-        command = "git clone {}"
-        exec_cmd(command.format(url))
+        if not bare:
+            command = "git clone {} {} {} {}".format(
+                filter_option,
+                "--reference {}".format(object_cache) if object_cache else "",
+                url,
+                name,
+            )
+            exec_cmd(command, cwd=owner_path)
+            return
+        exec_cmd("git init --bare {}".format(name), cwd=owner_path)
+        exec_cmd("git remote add origin {}".format(url), cwd=repo_path)
+        exec_cmd("git config --unset-all remote.origin.fetch", cwd=repo_path)
+        for refspec in get_refspecs(refs):
+            command = "git config --add remote.origin.fetch '{}'"
+            exec_cmd(command.format(refspec), cwd=repo_path)
+        if refs:
+            exec_cmd("git config remote.origin.tagOpt --no-tags", cwd=repo_path)
+        if object_cache:
+            alternates = os.path.join(repo_path, "objects", "info", "alternates")
+            with open(alternates, "w") as f:
+                f.write(os.path.join(object_cache, "objects") + "\n")
+        exec_cmd("git fetch {} origin".format(filter_option), cwd=repo_path)
     else:
         print(f"Existed '{name}' repository")
-        command = "git pull"
-        exec_cmd(command)
-    os.chdir(cur_dir)
+        command = "git fetch origin" if is_bare_repo(repo_path) else "git pull"
+        exec_cmd(command, cwd=repo_path)
+
 
+def get_refspecs(refs=[]):
+    if not refs:
+        return ["+refs/heads/*:refs/heads/*", "+refs/tags/*:refs/tags/*"]
+    return ["+refs/heads/{0}:refs/heads/{0}".format(ref) for ref in refs]
 
-def exec_cmd(command: str):
+
+def update_object_cache(cache_path, owner, name, url, filter_option=""):
+    """
+    Fetch a repository's branches into the shared object cache, under
+    `refs/cache/owner/name/` so that its objects stay reachable
     """
-    Get ouput of executing a command
+    if not os.path.exists(cache_path):
+        os.makedirs(cache_path)
+        exec_cmd("git init --bare .", cwd=cache_path)
+    command = "git fetch --no-tags {} {} '+refs/heads/*:refs/cache/{}/{}/heads/*'"
+    exec_cmd(command.format(filter_option, url, owner, name), cwd=cache_path)
+
+
+def get_partial_clone_filter(repo_path):
+    if not os.path.exists(repo_path):
+        return None
+    command = "git config --get-regexp 'remote\\..*\\.partialclonefilter'"
+    output = exec_cmd(command, cwd=repo_path)
+    return output[0].split(" ")[-1] if output else None
+
+
+def is_bare_repo(repo_path):
+    output = exec_cmd("git rev-parse --is-bare-repository", cwd=repo_path)
+    return bool(output) and output[0] == "true"
+
+
+def exec_cmd(command: str, cwd: str = None, timeout: float = None):
     """
-    result = subprocess.run(command, shell=True, capture_output=True, text=False)
-    output = result.stdout.strip(b"\n").split(b"\n") if result.stdout else []
+    Get ouput of executing a command, optionally inside the directory `cwd`.
+    A command running longer than `timeout` seconds raises a `TimeoutError`.
+    """
+    try:
+        result = subprocess.run(
+            command,
+            shell=True,
+            capture_output=True,
+            text=False,
+            cwd=cwd,
+            timeout=timeout,
+        )
+    except subprocess.TimeoutExpired:
+        raise TimeoutError("Command timed out after {}s: {}".format(timeout, command))
+    return decode_output(result.stdout)
+
+
+def decode_output(stdout: bytes):
+    """
+    Split a command's raw output into decoded lines
+    """
+    output = stdout.strip(b"\n").split(b"\n") if stdout else []
     output = [line.decode(encoding="utf8", errors="replace") for line in output]
     return output
 
 
-def get_commit_hashes(start=None, end=None):
+def count_commits(repo_path: str):
+    """
+    Estimate the size of a repository by its number of commits over all refs
+    """
+    if not os.path.exists(repo_path):
+        return 0
+    output = exec_cmd("git rev-list --count --all", cwd=repo_path)
+    if output and output[0].isdigit():
+        return int(output[0])
+    return 0
+
+
+def get_commit_hashes(start=None, end=None, cwd=None):
     """
-    Get commit hashes of a repository between `start` and `end` in the format of '%Y-%m-%d'
+    Get commit hashes of the repository at `cwd` between `start` and `end` in the format of '%Y-%m-%d'
     """
     if start is None and end is None:
         command = 'git log --all --no-decorate --no-merges --pretty=format:"%H"'
@@ -48,7 +161,85 @@ def get_commit_hashes(start=None, end=None):
         command = f'git log --all --after={start} --no-decorate --no-merges --pretty=format:"%H"'
     else:
         command = f'git log --all --after={start} --before={end} --no-decorate --no-merges --pretty=format:"%H"'
-    return exec_cmd(command)
+    return exec_cmd(command, cwd=cwd)
+
+
+def get_ref_tips(cwd=None):
+    """
+    Get the commit each ref of the repository at `cwd` points to, HEAD first
+    """
+    tips = {}
+    head = exec_cmd("git rev-parse --verify -q HEAD", cwd=cwd)
+    if head:
+        tips["HEAD"] = head[0]
+    output = exec_cmd("git for-each-ref --format='%(objectname) %(refname)'", cwd=cwd)
+    for line in output:
+        tip, ref = line.split(" ", 1)
+        tips[ref] = tip
+    return tips
+
+
+def get_new_commit_hashes(tips, old_tips, start=None, end=None, cwd=None):
+    """
+    Get the hashes of the commits reachable from `tips` but not from
+    `old_tips`, or None if git fails, e.g. when an old tip has been pruned
+    """
+    command = ["git", "rev-list", "--no-merges", "--stdin"]
+    if start is not None:
+        command.append("--after={}".format(start))
+    if end is not None:
+        command.append("--before={}".format(end))
+    revs = list(dict.fromkeys(tips.values()))
+    revs += ["^" + tip for tip in dict.fromkeys(old_tips.values())]
+    result = subprocess.run(
+        command,
+        input="".join(rev + "\n" for rev in revs).encode(),
+        capture_output=True,
+        cwd=cwd,
+    )
+    if result.returncode != 0:
+        return None
+    return decode_output(result.stdout)
+
+
+def get_patch_ids(commit_ids, pathspecs=[], cwd=None):
+    """
+    Get the `git patch-id --stable` of each commit's diff restricted to
+    `pathspecs`, computed in bulk. Commits without diff are left out.
+    """
+    diff_tree = subprocess.Popen(
+        ["git", "diff-tree", "--stdin", "-p", "-r", "--root", "--"] + pathspecs,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        cwd=cwd,
+    )
+    patch_id = subprocess.Popen(
+        ["git", "patch-id", "--stable"],
+        stdin=diff_tree.stdout,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        cwd=cwd,
+    )
+    diff_tree.stdout.close()
+
+    def write_ids():
+        try:
+            diff_tree.stdin.write("".join(id + "\n" for id in commit_ids).encode())
+        finally:
+            diff_tree.stdin.close()
+
+    writer = threading.Thread(target=write_ids)
+    writer.start()
+    stdout, _ = patch_id.communicate()
+    writer.join()
+    diff_tree.wait()
+
+    patch_ids = {}
+    for line in decode_output(stdout):
+        patch, commit_id = line.split(" ")
+        patch_ids[commit_id] = patch
+    return patch_ids
 
 
 def split_diff_log(file_diff_log):
@@ -148,11 +339,13 @@ def find_file_author(blame, file_path):
     return list(commit), list(author)
 
 
-def get_subs_dire_name(fileDirs):
+@lru_cache(maxsize=PATH_CACHE_SIZE)
+def get_path_metadata(file_path):
     """
-    Get the subsystem, directory, and file from a file path
+    Get the subsystem, directory, file and programming language of a file path.
+    The result is cached, as the same paths come back on every commit
     """
-    fileDirs = fileDirs.split("/")
+    fileDirs = file_path.split("/")
     if len(fileDirs) == 1:
         subsystem = "root"
         directory = "root"
@@ -160,8 +353,16 @@ def get_subs_dire_name(fileDirs):
         subsystem = fileDirs[0]
         directory = "/".join(fileDirs[0:-1])
     file_name = fileDirs[-1]
+    extension = os.path.splitext(file_name)[1].lower()
+
+    return subsystem, directory, file_name, EXT2LANG.get(extension, None)
+
 
-    return subsystem, directory, file_name
+def get_subs_dire_name(fileDirs):
+    """
+    Get the subsystem, directory, and file from a file path
+    """
+    return get_path_metadata(fileDirs)[:3]
 
 
 def calc_entropy(totalLOCModified, locModifiedPerFile):
@@ -258,8 +459,33 @@ LANG2EXT = {v: k for k, v in EXT2LANG.items()}
 
 
 def get_programming_language(file_path):
-    extension = os.path.splitext(file_path)[1].lower()
-    return EXT2LANG.get(extension, None)
+    return get_path_metadata(file_path)[3]
+
+
+def get_pathspecs(languages=[], include=[], exclude=[]):
+    """
+    Translate the language filter and the include/exclude directory globs
+    into git pathspecs, so that git never produces the filtered files
+    """
+    extensions = [ext for ext, lang in EXT2LANG.items() if lang in languages]
+    pathspecs = []
+    if include and extensions:
+        for pattern in include:
+            for ext in extensions:
+                pathspecs.append(
+                    ":(glob,icase){}/**/*{}".format(pattern.rstrip("/"), ext)
+                )
+    elif include:
+        for pattern in include:
+            pathspecs.append(":(glob){}".format(pattern.rstrip("/")))
+            pathspecs.append(":(glob){}/**".format(pattern.rstrip("/")))
+    elif extensions:
+        for ext in extensions:
+            pathspecs.append(":(glob,icase)**/*{}".format(ext))
+    for pattern in exclude:
+        pathspecs.append(":(exclude,glob){}".format(pattern.rstrip("/")))
+        pathspecs.append(":(exclude,glob){}/**".format(pattern.rstrip("/")))
+    return pathspecs
 
 
 def is_supported_language(language):
@@ -268,11 +494,87 @@ def is_supported_language(language):
     print(f"Language '{language}' is not supported")
 
 
+PICKLE_PROTOCOL = 5
+COMPRESSIONS = ["none", "zstd", "lz4"]
+MAGIC_BYTES = {b"\x28\xb5\x2f\xfd": "zstd", b"\x04\x22\x4d\x18": "lz4"}
+serialization = {"compression": "none", "level": None}
+
+
+def set_serialization(compression: str = "none", level: int = None):
+    """
+    Set how `save_pkl` compresses its pickles: "none", "zstd" or "lz4" with
+    an optional compression level. `load_pkl` detects the format by itself.
+    """
+    assert compression in COMPRESSIONS, "Invalid compression: {}".format(compression)
+    if compression != "none":
+        get_compression_module(compression)
+    serialization["compression"] = compression
+    serialization["level"] = level
+
+
+def get_compression_module(compression):
+    try:
+        if compression == "zstd":
+            import zstandard
+
+            return zstandard
+        import lz4.frame
+
+        return lz4.frame
+    except ImportError:
+        raise AssertionError(
+            "{} compression needs the {} package".format(
+                compression, "zstandard" if compression == "zstd" else "lz4"
+            )
+        )
+
+
+@contextmanager
+def compressed_writer(f, compression, level=None):
+    """
+    Stream the data written to the yielded file into `f`, compressed
+    """
+    if compression == "none":
+        yield f
+        return
+    module = get_compression_module(compression)
+    if compression == "zstd":
+        compressor = module.ZstdCompressor(level=3 if level is None else level)
+        writer = compressor.stream_writer(f, closefd=False)
+    else:
+        writer = module.LZ4FrameFile(
+            f, "wb", compression_level=0 if level is None else level
+        )
+    with writer:
+        yield writer
+
+
+@contextmanager
+def compressed_reader(f):
+    """
+    Yield a file decompressing `f` according to its magic bytes
+    """
+    compression = MAGIC_BYTES.get(f.peek(4)[:4], "none")
+    if compression == "none":
+        yield f
+        return
+    module = get_compression_module(compression)
+    if compression == "zstd":
+        reader = io.BufferedReader(
+            module.ZstdDecompressor().stream_reader(f, closefd=False)
+        )
+    else:
+        reader = module.LZ4FrameFile(f, "rb")
+    with reader:
+        yield reader
+
+
 def load_pkl(path):
     if not os.path.exists(path):
         return {}
     with open(path, "rb") as f:
-        data = pickle.load(f)
+        with compressed_reader(f) as reader:
+            data = pickle.load(reader)
     return data
 
 
@@ -284,13 +586,109 @@ def load_json(path):
     return data
 
 
+@contextmanager
+def atomic_write(path, mode="wb"):
+    """
+    Write to a temporary file next to `path` that replaces `path` only once it
+    is completely written, so a killed process never leaves a truncated file
+    """
+    tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def iter_json_array(path, chunk_size=1 << 20):
+    """
+    Stream the items of a JSON array file, or the records of a JSON Lines
+    file, without loading the whole file in memory
+    """
+    decoder = json.JSONDecoder()
+    with open(path, "r") as f:
+        buffer = f.read(chunk_size)
+        eof = len(buffer) < chunk_size
+        pos = 0
+        while pos < len(buffer) and buffer[pos].isspace():
+            pos += 1
+        if pos == len(buffer):
+            return
+        if buffer[pos] != "[":
+            # JSON Lines: the lines of the first chunk, then the file's, the
+            # chunk's last line being completed by the rest of its line
+            lines = buffer[pos:].split("\n")
+            lines[-1] += f.readline()
+            for line in itertools.chain(lines, f):
+                if line.strip():
+                    yield json.loads(line)
+            return
+        pos += 1
+        while True:
+            while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] == ","):
+                pos += 1
+            if pos < len(buffer) and buffer[pos] == "]":
+                return
+            try:
+                if pos == len(buffer):
+                    raise json.JSONDecodeError("Incomplete item", buffer, pos)
+                item, end = decoder.raw_decode(buffer, pos)
+                if not eof and (
+                    end == len(buffer) or buffer[end] not in " \t\r\n,]"
+                ):
+                    # a number may continue in the next chunk
+                    raise json.JSONDecodeError("Incomplete item", buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                chunk = f.read(chunk_size)
+                eof = len(chunk) < chunk_size
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                continue
+            yield item
+            pos = end
+
+
+class CountingWriter:
+    """
+    Count the bytes written into a file
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.num_bytes = 0
+
+    def write(self, data):
+        self.num_bytes += len(data)
+        return self.f.write(data)
+
+
 def save_pkl(data, path):
-    with open(path, "wb") as f:
-        pickle.dump(data, f)
+    """
+    Save `data` and get its pickled size, before compression
+    """
+    with atomic_write(path, "wb") as f:
+        compression, level = serialization["compression"], serialization["level"]
+        with compressed_writer(f, compression, level) as writer:
+            writer = CountingWriter(writer)
+            pickle.dump(data, writer, protocol=PICKLE_PROTOCOL)
+    return writer.num_bytes
+
+
+def get_pkl_size(data):
+    """
+    Get the size of `data` pickled as `save_pkl` does, before compression
+    """
+    return len(pickle.dumps(data, protocol=PICKLE_PROTOCOL))
 
 
 def save_json(data, path):
-    with open(path, "w") as f:
+    with atomic_write(path, "w") as f:
         json.dump(data, f, indent=4)
 
 